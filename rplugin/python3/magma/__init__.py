@@ -1,13 +1,20 @@
-import json
 import os
 from typing import Any, Dict, List, Optional, Tuple
 
 import pynvim
 from magma.images import Canvas, get_canvas_given_provider
-from magma.io import MagmaIOError, get_default_save_file, load, save
-from magma.magmabuffer import MagmaBuffer
+from magma.io import (
+    MagmaIOError,
+    get_default_save_file,
+    load,
+    save,
+    dump,
+    read_dump,
+)
+from magma.magmabuffer import LUA_HELPERS, MagmaBuffer
 from magma.options import MagmaOptions
 from magma.outputbuffer import OutputBuffer
+from magma.outputchunks import get_char_pixelsize, prewarm_converters
 from magma.runtime import get_available_kernels
 from magma.utils import DynamicPosition, MagmaException, Span, nvimui
 from pynvim import Nvim
@@ -25,6 +32,7 @@ class Magma:
     buffers: Dict[int, MagmaBuffer]
 
     timer: Optional[int]
+    update_interface_timer: Optional[int]
 
     options: MagmaOptions
 
@@ -35,54 +43,82 @@ class Magma:
         self.canvas = None
         self.buffers = {}
         self.timer = None
+        self.update_interface_timer = None
 
     def _initialize(self) -> None:
         assert not self.initialized
 
         self.options = MagmaOptions(self.nvim)
 
+        self._warn_if_slow_msgpack()
+
         self.canvas = get_canvas_given_provider(
             self.options.image_provider, self.nvim
         )
         self.canvas.init()
 
-        self.highlight_namespace = self.nvim.funcs.nvim_create_namespace(
-            "magma-highlights"
-        )
-        self.extmark_namespace = self.nvim.funcs.nvim_create_namespace(
-            "magma-extmarks"
-        )
-
-        self.timer = self.nvim.eval(
-            "timer_start(500, 'MagmaTick', {'repeat': -1})"
+        # Create the namespaces, start the tick timer, set up the autocommands
+        # and define the Lua helpers in a single round-trip.
+        results, error = self.nvim.api.call_atomic(
+            [
+                ["nvim_create_namespace", ["magma-highlights"]],
+                ["nvim_create_namespace", ["magma-extmarks"]],
+                [
+                    "nvim_eval",
+                    ["timer_start(500, 'MagmaTick', {'repeat': -1})"],
+                ],
+            ]
+            + [
+                ["nvim_command", [command]]
+                for command in self._get_autocommands()
+            ]
+            + [["nvim_exec_lua", [LUA_HELPERS, []]]]
         )
+        if error is not None:
+            index, _, message = error
+            raise MagmaException(
+                f"Failed to initialize (call #{index}): {message}"
+            )
+        (
+            self.highlight_namespace,
+            self.extmark_namespace,
+            self.timer,
+        ) = results[:3]
 
-        self._set_autocommands()
+        prewarm_converters()
 
         self.initialized = True
 
-    def _set_autocommands(self) -> None:
-        self.nvim.command("augroup magma")
-        self.nvim.command(
-            "  autocmd CursorMoved  * call MagmaUpdateInterface()"
-        )
-        self.nvim.command(
-            "  autocmd CursorMovedI * call MagmaUpdateInterface()"
-        )
-        self.nvim.command(
-            "  autocmd WinScrolled  * call MagmaUpdateInterface()"
-        )
-        self.nvim.command(
-            "  autocmd BufEnter     * call MagmaUpdateInterface()"
-        )
-        self.nvim.command(
-            "  autocmd BufLeave     * call MagmaClearInterface()"
-        )
-        self.nvim.command(
-            "  autocmd BufUnload    * call MagmaOnBufferUnload()"
-        )
-        self.nvim.command("  autocmd ExitPre      * call MagmaOnExitPre()")
-        self.nvim.command("augroup END")
+    def _warn_if_slow_msgpack(self) -> None:
+        # pynvim silently falls back to msgpack's pure-Python implementation
+        # when the C extension isn't available, which makes every RPC
+        # considerably slower.
+        import msgpack
+
+        if msgpack.Packer.__module__ == "msgpack.fallback":
+            self.nvim.api.notify(
+                "msgpack is using its pure-Python fallback, which slows down "
+                "every RPC; run `pip install --upgrade msgpack` to get the C "
+                "extension.",
+                pynvim.logging.WARN,
+                {"title": "Magma"},
+            )
+
+    def _get_autocommands(self) -> List[str]:
+        return [
+            "augroup magma",
+            "  autocmd CursorMoved  * call MagmaUpdateInterface()",
+            "  autocmd CursorMovedI * call MagmaUpdateInterface()",
+            "  autocmd WinScrolled  * call MagmaUpdateInterface()",
+            "  autocmd BufEnter     * call MagmaUpdateInterface()",
+            "  autocmd BufLeave     * call MagmaClearInterface()",
+            "  autocmd BufUnload    * call MagmaOnBufferUnload()",
+            "  autocmd VimResized   * call MagmaOnVimResized()",
+            "  autocmd WinClosed    * call"
+            " MagmaOnWinClosed(str2nr(expand('<amatch>')))",
+            "  autocmd ExitPre      * call MagmaOnExitPre()",
+            "augroup END",
+        ]
 
     def _deinitialize(self) -> None:
         for magma in self.buffers.values():
@@ -91,6 +127,8 @@ class Magma:
             self.canvas.deinit()
         if self.timer is not None:
             self.nvim.funcs.timer_stop(self.timer)
+        if self.update_interface_timer is not None:
+            self.nvim.funcs.timer_stop(self.update_interface_timer)
 
     def _initialize_if_necessary(self) -> None:
         if not self.initialized:
@@ -215,8 +253,20 @@ class Magma:
 
         bufno = self.nvim.current.buffer.number
         span = Span(
-            DynamicPosition(self.nvim, self.extmark_namespace, bufno, *pos[0]),
-            DynamicPosition(self.nvim, self.extmark_namespace, bufno, *pos[1]),
+            DynamicPosition(
+                self.nvim,
+                self.extmark_namespace,
+                bufno,
+                *pos[0],
+                pool=magma.extmark_pool,
+            ),
+            DynamicPosition(
+                self.nvim,
+                self.extmark_namespace,
+                bufno,
+                *pos[1],
+                pool=magma.extmark_pool,
+            ),
         )
 
         code = span.get_text(self.nvim)
@@ -230,8 +280,22 @@ class Magma:
         assert magma is not None
         bufno = self.nvim.current.buffer.number
         span = Span(
-            DynamicPosition(self.nvim, self.extmark_namespace, bufno, 0, 0),
-            DynamicPosition(self.nvim, self.extmark_namespace, bufno, 0, 0),
+            DynamicPosition(
+                self.nvim,
+                self.extmark_namespace,
+                bufno,
+                0,
+                0,
+                pool=magma.extmark_pool,
+            ),
+            DynamicPosition(
+                self.nvim,
+                self.extmark_namespace,
+                bufno,
+                0,
+                0,
+                pool=magma.extmark_pool,
+            ),
         )
         magma.run_code(expr, span)
 
@@ -251,22 +315,46 @@ class Magma:
     @pynvim.command("MagmaEvaluateVisual", sync=True)  # type: ignore
     @nvimui  # type: ignore
     def command_evaluate_visual(self) -> None:
-        _, lineno_begin, colno_begin, _ = self.nvim.funcs.getpos("'<")
-        _, lineno_end, colno_end, _ = self.nvim.funcs.getpos("'>")
+        (
+            lineno_begin,
+            colno_begin,
+            length_begin,
+            lineno_end,
+            colno_end,
+            length_end,
+        ) = self._get_marks("'<", "'>")
         span = (
-            (
-                lineno_begin - 1,
-                min(colno_begin, len(self.nvim.funcs.getline(lineno_begin)))
-                - 1,
-            ),
-            (
-                lineno_end - 1,
-                min(colno_end, len(self.nvim.funcs.getline(lineno_end))),
-            ),
+            (lineno_begin - 1, min(colno_begin, length_begin) - 1),
+            (lineno_end - 1, min(colno_end, length_end)),
         )
 
         self._do_evaluate(span)
 
+    def _get_marks(
+        self, begin_mark: str, end_mark: str
+    ) -> Tuple[int, int, int, int, int, int]:
+        """
+        Get the line and column numbers (as given by `getpos()`) of the two
+        marks, each followed by the length of its line, in a single RPC.
+        """
+
+        return tuple(  # type: ignore
+            self.nvim.exec_lua(
+                """
+                local positions = {}
+                for _, mark in ipairs({...}) do
+                    local _, lineno, colno = unpack(vim.fn.getpos(mark))
+                    table.insert(positions, lineno)
+                    table.insert(positions, colno)
+                    table.insert(positions, #vim.fn.getline(lineno))
+                end
+                return positions
+                """,
+                begin_mark,
+                end_mark,
+            )
+        )
+
     @pynvim.command("MagmaEvaluateOperator", sync=True)  # type: ignore
     @nvimui  # type: ignore
     def command_evaluate_operator(self) -> None:
@@ -344,15 +432,12 @@ class Magma:
                 self.options, self.nvim.current.buffer
             )
 
-        dirname = os.path.dirname(path)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
 
         magma = self._get_magma(True)
         assert magma is not None
 
-        with open(path, "w") as file:
-            json.dump(save(magma), file)
+        dump(save(magma), path)
 
     @pynvim.command("MagmaLoad", nargs="?", sync=True)  # type: ignore
     @nvimui  # type: ignore
@@ -371,14 +456,13 @@ class Magma:
                 "Magma is already initialized; MagmaLoad initializes Magma."
             )
 
-        with open(path) as file:
-            data = json.load(file)
+        data = read_dump(path)
 
         magma = None
 
         try:
             MagmaIOError.assert_has_key(data, "version", int)
-            if (version := data["version"]) != 1:
+            if (version := data["version"]) not in (1, 2):
                 raise MagmaIOError(f"Bad version: {version}")
 
             MagmaIOError.assert_has_key(data, "kernel", str)
@@ -415,6 +499,29 @@ class Magma:
 
         self._deinit_buffer(magma)
 
+    @pynvim.function("MagmaOnVimResized", sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def function_on_vim_resized(self, _: Any) -> None:
+        # The size of the terminal's cells may have changed along with it.
+        get_char_pixelsize.cache_clear()
+
+    @pynvim.function("MagmaOnWinClosed", sync=False)  # type: ignore
+    @nvimui  # type: ignore
+    def function_on_win_closed(self, args: List[int]) -> None:
+        # An output window closed by the user (e.g., with `:only`) has to be
+        # opened again, so what was last drawn no longer applies. (As this is
+        # asynchronous, the windows which we close ourselves are forgotten
+        # before it gets called.)
+        if not args:
+            return
+        window = args[0]
+        for magma in self.buffers.values():
+            if any(
+                output.display_window == window
+                for output in magma.outputs.values()
+            ):
+                magma.invalidate_interface()
+
     @pynvim.function("MagmaOnExitPre", sync=True)  # type: ignore
     @nvimui  # type: ignore
     def function_on_exit_pre(self, _: Any) -> None:
@@ -425,15 +532,29 @@ class Magma:
     def function_magma_tick(self, _: Any) -> None:
         self._initialize_if_necessary()
 
-        magma = self._get_magma(False)
-        if magma is None:
-            return
-
-        magma.tick()
+        current_bufno = self.nvim.current.buffer.number
+        for bufno, magma in self.buffers.items():
+            # Kernels of background buffers keep making progress, but we don't
+            # redraw an interface which isn't being shown; `BufEnter` will
+            # update it once the buffer becomes current again.
+            magma.tick(update_interface=bufno == current_bufno)
 
     @pynvim.function("MagmaUpdateInterface", sync=True)  # type: ignore
     @nvimui  # type: ignore
     def function_update_interface(self, _: Any) -> None:
+        # Bursts of events (e.g. while scrolling) are coalesced into a single
+        # update, done once no new event has arrived for a frame's worth of
+        # time.
+        if self.update_interface_timer is not None:
+            self.nvim.funcs.timer_stop(self.update_interface_timer)
+        self.update_interface_timer = self.nvim.funcs.timer_start(
+            16, "MagmaDoUpdateInterface"
+        )
+
+    @pynvim.function("MagmaDoUpdateInterface", sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    def function_do_update_interface(self, _: Any) -> None:
+        self.update_interface_timer = None
         self._update_interface()
 
     @pynvim.function("MagmaOperatorfunc", sync=True)  # type: ignore
@@ -444,8 +565,14 @@ class Magma:
 
         kind = args[0]
 
-        _, lineno_begin, colno_begin, _ = self.nvim.funcs.getpos("'[")
-        _, lineno_end, colno_end, _ = self.nvim.funcs.getpos("']")
+        (
+            lineno_begin,
+            colno_begin,
+            length_begin,
+            lineno_end,
+            colno_end,
+            length_end,
+        ) = self._get_marks("'[", "']")
 
         if kind == "line":
             colno_begin = 1
@@ -458,15 +585,8 @@ class Magma:
             )
 
         span = (
-            (
-                lineno_begin - 1,
-                min(colno_begin, len(self.nvim.funcs.getline(lineno_begin)))
-                - 1,
-            ),
-            (
-                lineno_end - 1,
-                min(colno_end, len(self.nvim.funcs.getline(lineno_end))),
-            ),
+            (lineno_begin - 1, min(colno_begin, length_begin) - 1),
+            (lineno_end - 1, min(colno_end, length_end)),
         )
 
         self._do_evaluate(span)
@@ -485,8 +605,23 @@ class Magma:
         bufno = self.nvim.current.buffer.number
         span = Span(
             DynamicPosition(
-                self.nvim, self.extmark_namespace, bufno, start - 1, 0
+                self.nvim,
+                self.extmark_namespace,
+                bufno,
+                start - 1,
+                0,
+                pool=magma.extmark_pool,
             ),
-            DynamicPosition(self.nvim, self.extmark_namespace, bufno, end - 1, -1),
+            DynamicPosition(
+                self.nvim,
+                self.extmark_namespace,
+                bufno,
+                end - 1,
+                -1,
+                pool=magma.extmark_pool,
+            ),
+        )
+        magma._delete_all_cells_in_span(span)
+        magma.add_output(
+            span, OutputBuffer(self.nvim, self.canvas, self.options)
         )
-        magma.outputs[span] = OutputBuffer(self.nvim, self.canvas, self.options)
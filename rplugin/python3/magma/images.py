@@ -1,15 +1,14 @@
-from typing import Set, Dict
+from typing import Callable, Optional, Protocol, Set, Dict, List, Tuple
+from collections import OrderedDict
+import asyncio
 import os
-from abc import ABC, abstractmethod
-import time
 
 from pynvim import Nvim
 
 from magma.utils import MagmaException
 
 
-class Canvas(ABC):
-    @abstractmethod
+class Canvas(Protocol):
     def init(self) -> None:
         """
         Initialize the canvas.
@@ -17,7 +16,6 @@ class Canvas(ABC):
         This will be called before the canvas is ever used.
         """
 
-    @abstractmethod
     def deinit(self) -> None:
         """
         Deinitialize the canvas.
@@ -25,7 +23,6 @@ class Canvas(ABC):
         The canvas will not be used after this operation.
         """
 
-    @abstractmethod
     def present(self) -> None:
         """
         Present the canvas.
@@ -36,13 +33,11 @@ class Canvas(ABC):
         to reduce flickering.
         """
 
-    @abstractmethod
     def clear(self) -> None:
         """
         Clear all images from the canvas.
         """
 
-    @abstractmethod
     def add_image(
         self,
         path: str,
@@ -103,24 +98,44 @@ class NoCanvas(Canvas):
         pass
 
 
+# (identifier, x, y, width, height)
+PlacementKey = Tuple[str, int, int, int, int]
+
+
 class UeberzugCanvas(Canvas):
     ueberzug_canvas: "ueberzug.Canvas"  # type: ignore
 
-    identifiers: Dict[str, "ueberzug.Placement"]  # type: ignore
+    # Placements, from least to most recently used. Every new position or size
+    # of an image gets its own placement, so we only keep the most recent ones.
+    identifiers: "OrderedDict[PlacementKey, ueberzug.Placement]"  # type: ignore
+    MAX_PLACEMENTS = 256
+
+    pid_suffix: str
+
+    visible_value: "ueberzug.Visibility"  # type: ignore
+    invisible_value: "ueberzug.Visibility"  # type: ignore
+    scaler_value: str
 
-    _visible: Set[str]
-    _to_make_visible: Set[str]
-    _to_make_invisible: Set[str]
+    # What is currently visible, and what should be visible after the next
+    # call to `present`.
+    _visible: Set[PlacementKey]
+    _next_visible: Set[PlacementKey]
 
     def __init__(self) -> None:
+        # ueberzug is only imported when it is actually used, but only once;
+        # the values used in hot paths are kept around.
         import ueberzug.lib.v0 as ueberzug
 
+        self.visible_value = ueberzug.Visibility.VISIBLE
+        self.invisible_value = ueberzug.Visibility.INVISIBLE
+        self.scaler_value = ueberzug.ScalerOption.FIT_CONTAIN.value
+
         self.ueberzug_canvas = ueberzug.Canvas()
-        self.identifiers = {}
+        self.identifiers = OrderedDict()
+        self.pid_suffix = f"-{os.getpid()}"
 
         self._visible = set()
-        self._to_make_visible = set()
-        self._to_make_invisible = set()
+        self._next_visible = set()
 
     def init(self) -> None:
         self.ueberzug_canvas.__enter__()
@@ -130,25 +145,17 @@ class UeberzugCanvas(Canvas):
             self.ueberzug_canvas.__exit__()
 
     def present(self) -> None:
-        import ueberzug.lib.v0 as ueberzug
-
-        self._to_make_invisible.difference_update(self._to_make_visible)
-        for identifier in self._to_make_invisible:
-            self.identifiers[
-                identifier
-            ].visibility = ueberzug.Visibility.INVISIBLE
-        for identifier in self._to_make_visible:
-            self.identifiers[
-                identifier
-            ].visibility = ueberzug.Visibility.VISIBLE
-            self._visible.add(identifier)
-        self._to_make_invisible.clear()
-        self._to_make_visible.clear()
+        # Only touch the placements whose visibility actually changes, and
+        # send all of the changes to ueberzug at once.
+        with self.ueberzug_canvas.lazy_drawing:
+            for key in self._visible - self._next_visible:
+                self.identifiers[key].visibility = self.invisible_value
+            for key in self._next_visible - self._visible:
+                self.identifiers[key].visibility = self.visible_value
+        self._visible = set(self._next_visible)
 
     def clear(self) -> None:
-        for identifier in self._visible:
-            self._to_make_invisible.add(identifier)
-        self._visible.clear()
+        self._next_visible.clear()
 
     def add_image(
         self,
@@ -159,115 +166,240 @@ class UeberzugCanvas(Canvas):
         width: int,
         height: int,
     ) -> None:
-        import ueberzug.lib.v0 as ueberzug
-
         if width > 0 and height > 0:
-            identifier += f"-{os.getpid()}-{x}-{y}-{width}-{height}"
+            key = (identifier, x, y, width, height)
 
-            if identifier in self.identifiers:
-                img = self.identifiers[identifier]
+            if key in self.identifiers:
+                img = self.identifiers[key]
+                self.identifiers.move_to_end(key)
             else:
                 img = self.ueberzug_canvas.create_placement(
-                    identifier,
+                    f"{identifier}{self.pid_suffix}-{x}-{y}-{width}-{height}",
                     x=x,
                     y=y,
                     width=width,
                     height=height,
-                    scaler=ueberzug.ScalerOption.FIT_CONTAIN.value,
+                    scaler=self.scaler_value,
                 )
-                self.identifiers[identifier] = img
-            img.path = path
+                self.identifiers[key] = img
+                if len(self.identifiers) > self.MAX_PLACEMENTS:
+                    self._evict_oldest_placement()
+            # Setting an attribute of a placement sends it to ueberzug again.
+            if img.path != path:
+                img.path = path
+
+            self._next_visible.add(key)
 
-            self._to_make_visible.add(identifier)
+    def _evict_oldest_placement(self) -> None:
+        key, img = self.identifiers.popitem(last=False)
+        if key in self._visible:
+            img.visibility = self.invisible_value
+            self._visible.discard(key)
+        self._next_visible.discard(key)
 
 
 class KittyImage:
     # Adapted from https://sw.kovidgoyal.net/kitty/graphics-protocol/
 
+    # The image data is transmitted to the terminal only once, and then shown
+    # by (possibly many) `KittyPlacement`s referring to it by its ID.
+
     def __init__(
         self,
         id: int,
         path: str,
-        row: int,
-        col: int,
-        width: int,
-        height: int,
         nvim: Nvim,
     ):
         self.id = id
         self.path = path
-        self.row = row
-        self.col = col
-        self.width = width
-        self.height = height
         self.nvim = nvim
 
+        self.transmitted = False
+        self.size = self._get_stored_size()
+
+        # Inside tmux, commands have to be wrapped in a passthrough sequence,
+        # with their escape characters doubled. Only the framing contains
+        # escapes (base64 payloads and the keys never do), so we can just
+        # use pre-escaped framing instead of escaping each command.
+        if "tmux" in os.environ.get("TERM", ""):
+            self._prefix = b"\033Ptmux;\033\033_G"
+            self._suffix = b"\033\033\\\033\\"
+        else:
+            self._prefix = b"\033_G"
+            self._suffix = b"\033\\"
+
+    def _get_stored_size(self) -> int:
+        # The terminal keeps the decoded image, so for PNGs (which is all we
+        # send for now) the size comes from the dimensions in the header.
+        with open(self.path, "rb") as f:
+            header = f.read(24)
+        if header[:8] == b"\x89PNG\r\n\x1a\n" and len(header) == 24:
+            width = int.from_bytes(header[16:20], "big")
+            height = int.from_bytes(header[20:24], "big")
+            return width * height * 4
+        return os.path.getsize(self.path)
+
     def serialize_gr_command(self, **cmd):  # type: ignore
         payload = cmd.pop("payload", None)
-        cmd = ",".join("{}={}".format(k, v) for k, v in cmd.items())  # type: ignore
-        ans = []  # type: ignore
-        w = ans.append
-        w(b"\033_G"), w(cmd.encode("ascii"))  # type: ignore
+        ans = bytearray(self._prefix)
+        for k, v in cmd.items():
+            if len(ans) > len(self._prefix):
+                ans += b","
+            ans += b"%s=%s" % (k.encode("ascii"), str(v).encode("ascii"))
         if payload:
-            w(b";")
-            w(payload)
-        w(b"\033\\")
-        ans = b"".join(ans)  # type: ignore
-        if "tmux" in os.environ["TERM"]:
-            ans = b"\033Ptmux;" + ans.replace(b"\033", b"\033\033") + b"\033\\"  # type: ignore
-        return ans
-
-    def write_chunked(self, **cmd):  # type: ignore
-        from base64 import standard_b64encode
-
-        data = standard_b64encode(cmd.pop("data"))
-        while data:
-            chunk, data = data[:4096], data[4096:]
-            m = 1 if data else 0
-            self.nvim.lua.stdout.write(
-                self.serialize_gr_command(payload=chunk, m=m, **cmd)  # type: ignore
+            ans += b";"
+            ans += payload
+        ans += self._suffix
+        return bytes(ans)
+
+    def serialize_chunked(self, **cmd) -> List[bytes]:  # type: ignore
+        try:
+            # SIMD-accelerated, and otherwise a drop-in replacement.
+            from pybase64 import b64encode as standard_b64encode
+        except ImportError:
+            from base64 import standard_b64encode
+
+        # Every 3072 bytes of data encode to exactly 4096 bytes of base64, so
+        # we encode the data piece by piece instead of encoding all of it and
+        # then slicing the result. The pieces are memoryview slices, so they
+        # aren't copied before being encoded either.
+        # Only the first chunk carries the keys, so the framing of the others
+        # is the same for all of them.
+        more = self._prefix + b"m=1;"
+        last = self._prefix + b"m=0;"
+        suffix = self._suffix
+        commands = []
+        with memoryview(cmd.pop("data")) as data:
+            size = len(data)
+            commands.append(
+                self.serialize_gr_command(  # type: ignore
+                    payload=standard_b64encode(data[:3072]),
+                    m=1 if size > 3072 else 0,
+                    **cmd,
+                )
             )
-            cmd.clear()
+            for i in range(3072, size, 3072):
+                commands.append(
+                    (more if i + 3072 < size else last)
+                    + standard_b64encode(data[i : i + 3072])
+                    + suffix
+                )
+        return commands
 
-    def show(self) -> None:
-        with open(self.path, "rb") as f:
-            self.write_chunked(  # type: ignore
-                a="T",  # transmit directly to the terminal
+    def serialize_transmit(self) -> List[bytes]:
+        """
+        Get the commands to transmit the image, or nothing if it has already
+        been transmitted.
+        """
+
+        import mmap
+
+        if self.transmitted:
+            return []
+
+        with open(self.path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            commands = self.serialize_chunked(  # type: ignore
+                a="t",  # transmit to the terminal, without displaying
                 i=self.id,
                 f=100,  # for now, only png
-                v=self.height,
-                s=self.width,
-                C=1,
-                z=10,
                 q=2,
-                data=f.read(),
+                data=data,
             )
+        self.transmitted = True
+        return commands
+
+    def serialize_delete(self) -> bytes:
+        return self.serialize_gr_command(  # type: ignore
+            a="d",  # remove the image data, along with all its placements
+            d="I",
+            i=self.id,
+            q=2,
+        )
 
-    def hide(self) -> None:
-        self.nvim.lua.stdout.write(
-            self.serialize_gr_command(  # type: ignore
-                i=self.id,
-                a="d",  # remove image
+
+class KittyPlacement:
+    def __init__(self, id: int, image: KittyImage, row: int, col: int):
+        self.id = id
+        self.image = image
+        self.row = row
+        self.col = col
+
+    def serialize_show(self) -> List[bytes]:
+        # Images are placed at the cursor, so we move the terminal's cursor
+        # there (saving and then restoring its position) -- this doesn't
+        # involve NeoVim's cursor at all.
+        return self.image.serialize_transmit() + [
+            b"\033[s\033[%d;%dH" % (self.row + 1, self.col + 1),
+            self.image.serialize_gr_command(  # type: ignore
+                a="p",  # display an already transmitted image
+                i=self.image.id,
+                p=self.id,
+                C=1,
+                z=10,
                 q=2,
-            )
+            ),
+            b"\033[u",
+        ]
+
+    def serialize_hide(self) -> bytes:
+        return self.image.serialize_gr_command(  # type: ignore
+            a="d",  # remove this placement, but keep the image data
+            d="i",
+            i=self.image.id,
+            p=self.id,
+            q=2,
         )
 
 
 class Kitty(Canvas):
     nvim: Nvim
-    images: Dict[str, KittyImage]
-    to_make_visible: Set[str]
-    to_make_invisible: Set[str]
-    visible: Set[str]
+    # Images are keyed by their checksum, so that each is only transmitted
+    # once; placements are keyed by checksum, position and size (see
+    # `PlacementKey`). Images are kept from least to most recently used, and
+    # only the most recent ones are kept in the terminal.
+    images: "OrderedDict[str, KittyImage]"
+    MAX_IMAGES = 256
+    # The terminal evicts images on its own beyond a storage quota (320MB by
+    # default, in Kitty), after which placing them silently fails, since we
+    # don't read the terminal's responses. So we evict them before that.
+    stored_size: int
+    MAX_STORED_SIZE = 256 << 20
+    # Placements are kept in the same way, as every new position of an image
+    # gets its own placement.
+    placements: "OrderedDict[PlacementKey, KittyPlacement]"
+    MAX_PLACEMENTS = 256
+    # Placements to show, by position; only the last one added at each
+    # position is shown.
+    to_make_visible: Dict[Tuple[int, int], PlacementKey]
+    to_make_invisible: Set[PlacementKey]
+    visible: Set[PlacementKey]
+    # IDs of deleted images and placements are reused.
     next_id: int
+    free_ids: List[int]
+    # Commands to be sent on the next draw, before anything else.
+    pending_commands: List[bytes]
+
+    # Bursts of `present` calls (e.g. while scrolling) are coalesced into a
+    # single draw, this long after the first of them.
+    PRESENT_DELAY = 0.04
+    _present_timer: Optional[asyncio.TimerHandle]
 
     def __init__(self, nvim: Nvim):
         self.nvim = nvim
-        self.images = {}
+        self.images = OrderedDict()
+        self.stored_size = 0
+        self.placements = OrderedDict()
         self.visible = set()
-        self.to_make_visible = set()
+        self.to_make_visible = {}
         self.to_make_invisible = set()
-        self.next_id = 0
+        # IDs must be nonzero. Image and placement IDs are separate namespaces,
+        # but sharing the counter keeps things simple.
+        self.next_id = 1
+        self.free_ids = []
+        self.pending_commands = []
+        self._present_timer = None
         nvim.exec_lua(
             """
             local fd = vim.loop.new_pipe(false)
@@ -284,54 +416,93 @@ class Kitty(Canvas):
         pass
 
     def deinit(self) -> None:
-        pass
+        if self._present_timer is not None:
+            self._present_timer.cancel()
+            self._present_timer = None
+
+        # The terminal would otherwise keep the images (and their placements)
+        # until it is closed. This is done right away, as NeoVim may be
+        # exiting.
+        commands = [
+            image.serialize_delete()
+            for image in self.images.values()
+            if image.transmitted
+        ]
+        if commands:
+            self.nvim.lua.stdout.write(b"".join(commands))
+        self.images.clear()
+        self.placements.clear()
+        self.visible.clear()
+        self.to_make_visible.clear()
+        self.to_make_invisible.clear()
+        self.pending_commands.clear()
+        self.stored_size = 0
 
     def present(self) -> None:
-        # images to both show and hide should be ignored
-        to_work_on = self.to_make_visible.difference(
-            self.to_make_visible.intersection(self.to_make_invisible)
-        )
-        self.to_make_invisible.difference_update(self.to_make_visible)
-        for identifier in self.to_make_invisible:
-
-            def hide_fn(image: KittyImage) -> None:
-                image.hide()
-                # we need the sleep here, otherwise the escape codes might
-                # `spill` over into the buffer when doing
-                # several rapid operations consectively
-                time.sleep(0.01)
-
-            self.nvim.async_call(hide_fn, self.images[identifier])
-        for identifier in to_work_on:
-            image = self.images[identifier]
-
-            def fn(nvim: Nvim, image: KittyImage) -> None:
-                eventignore_save = nvim.options["eventignore"]
-                nvim.options["eventignore"] = "all"
-
-                org_position = nvim.current.window.cursor
-                # We need to move the cursor to the place where we want to
-                # place the image.
-                # We need to make sure we are still in the buffer.
-                nvim.current.window.cursor = (
-                    min(image.row + 1, len(nvim.current.buffer)),
-                    image.col,
-                )
-                image.show()
-                time.sleep(0.01)
+        if self._present_timer is None:
+            self._present_timer = self.nvim.loop.call_later(
+                self.PRESENT_DELAY, self._do_present
+            )
 
-                nvim.current.window.cursor = org_position
-                nvim.options["eventignore"] = eventignore_save
+    def _do_present(self) -> None:
+        self._present_timer = None
 
-            self.nvim.async_call(fn, self.nvim, image)
-        self.visible.update(self.to_make_visible)
+        # This runs as a callback of the event loop, which would only log
+        # the error.
+        try:
+            self._draw()
+        except Exception as err:
+            self.nvim.async_call(
+                self.nvim.err_write, "[Magma] " + str(err) + "\n"
+            )
+        finally:
+            # Whatever couldn't be drawn is dropped, rather than failing
+            # again on every draw; placements to hide are kept, to be hidden
+            # next time.
+            self.to_make_visible.clear()
+            self.pending_commands.clear()
+
+    def _draw(self) -> None:
+        # Placements are shown in the order the terminal draws them (top to
+        # bottom, then left to right), rather than in hash order.
+        to_make_visible = [
+            key
+            for _, key in sorted(
+                self.to_make_visible.items(), key=lambda item: item[0][::-1]
+            )
+        ]
+        # images to both show and hide should be ignored
+        to_work_on = [
+            key for key in to_make_visible if key not in self.to_make_invisible
+        ]
+        self.to_make_invisible.difference_update(to_make_visible)
+
+        commands = list(self.pending_commands)
+        for key in self.to_make_invisible:
+            commands.append(self.placements[key].serialize_hide())
+        for key in to_work_on:
+            commands.extend(self.placements[key].serialize_show())
+
+        # All of the drawing is done in a single write (joined only once, as
+        # it may include whole images), and only if there is something to
+        # draw at all. It is framed as a synchronized update, so that the
+        # terminal shows it all at once (terminals that don't support it just
+        # ignore the framing).
+        if commands:
+            commands.insert(0, b"\033[?2026h")
+            commands.append(b"\033[?2026l")
+            self.nvim.async_call(
+                self.nvim.lua.stdout.write, b"".join(commands)
+            )
+        self.visible.update(to_make_visible)
         self.to_make_invisible.clear()
-        self.to_make_visible.clear()
 
     def clear(self) -> None:
-        for identifier in self.visible:
-            self.to_make_invisible.add(identifier)
+        self.to_make_invisible |= self.visible
         self.visible.clear()
+        # Drop whatever was added since the last draw, if it hasn't happened
+        # yet.
+        self.to_make_visible.clear()
 
     def add_image(
         self,
@@ -343,27 +514,87 @@ class Kitty(Canvas):
         height: int,
     ) -> None:
         if identifier not in self.images:
-            self.images[identifier] = KittyImage(
-                id=self.next_id,
+            image = KittyImage(
+                id=self._take_id(),
                 path=path,
+                nvim=self.nvim,
+            )
+            self.images[identifier] = image
+            self.stored_size += image.size
+            # The new image itself is never evicted.
+            while len(self.images) > 1 and (
+                len(self.images) > self.MAX_IMAGES
+                or self.stored_size > self.MAX_STORED_SIZE
+            ):
+                self._evict_oldest_image()
+        else:
+            self.images.move_to_end(identifier)
+
+        key = (identifier, x, y, width, height)
+        if key not in self.placements:
+            self.placements[key] = KittyPlacement(
+                id=self._take_id(),
+                image=self.images[identifier],
                 row=y,
                 col=x,
-                width=width,
-                height=height,
-                nvim=self.nvim,
             )
-            self.next_id += 1
+            if len(self.placements) > self.MAX_PLACEMENTS:
+                self._evict_oldest_placement()
         else:
-            self.images[identifier].path = path
-        self.to_make_visible.add(identifier)
+            self.placements.move_to_end(key)
+        # If something else was going to be drawn here, it is superseded.
+        self.to_make_visible[(x, y)] = key
+
+    def _take_id(self) -> int:
+        if self.free_ids:
+            return self.free_ids.pop()
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    def _evict_oldest_image(self) -> None:
+        _, image = self.images.popitem(last=False)
+        self.stored_size -= image.size
+        if image.transmitted:
+            self.pending_commands.append(image.serialize_delete())
+        self.free_ids.append(image.id)
+
+        # Deleting the image also deleted all of its placements.
+        for key, placement in list(self.placements.items()):
+            if placement.image is image:
+                del self.placements[key]
+                self.free_ids.append(placement.id)
+                self.visible.discard(key)
+                self.to_make_invisible.discard(key)
+        self.to_make_visible = {
+            position: key
+            for position, key in self.to_make_visible.items()
+            if key in self.placements
+        }
+
+    def _evict_oldest_placement(self) -> None:
+        key, placement = self.placements.popitem(last=False)
+        if key in self.visible or key in self.to_make_invisible:
+            self.pending_commands.append(placement.serialize_hide())
+            self.visible.discard(key)
+            self.to_make_invisible.discard(key)
+        self.free_ids.append(placement.id)
+        self.to_make_visible = {
+            position: other
+            for position, other in self.to_make_visible.items()
+            if other != key
+        }
+
+
+_CANVAS_PROVIDERS: Dict[str, Callable[[Nvim], Canvas]] = {
+    "none": lambda _: NoCanvas(),
+    "ueberzug": lambda _: UeberzugCanvas(),
+    "kitty": Kitty,
+}
 
 
 def get_canvas_given_provider(name: str, nvim: Nvim) -> Canvas:
-    if name == "none":
-        return NoCanvas()
-    elif name == "ueberzug":
-        return UeberzugCanvas()
-    elif name == "kitty":
-        return Kitty(nvim)
-    else:
+    provider = _CANVAS_PROVIDERS.get(name)
+    if provider is None:
         raise MagmaException(f"Unknown image provider: '{name}'")
+    return provider(nvim)
@@ -1,13 +1,14 @@
-from typing import Type, Optional, Dict, Any
+from typing import Type, Optional, Dict, Any, List, Tuple
 import os
+import json
 
 from pynvim.api import Buffer
 
 from magma.utils import MagmaException, Span, DynamicPosition
 from magma.options import MagmaOptions
-from magma.outputchunks import OutputStatus, Output, to_outputchunk
+from magma.outputchunks import OutputStatus, Output
 from magma.outputbuffer import OutputBuffer
-from magma.magmabuffer import MagmaBuffer
+from magma.magmabuffer import MagmaBuffer, CHECKSUM_ALGORITHM
 
 
 class MagmaIOError(Exception):
@@ -39,94 +40,187 @@ def get_default_save_file(options: MagmaOptions, buffer: Buffer) -> str:
 def load(magmabuffer: MagmaBuffer, data: Dict[str, Any]) -> None:
     MagmaIOError.assert_has_key(data, "content_checksum", str)
 
-    if magmabuffer._get_content_checksum() != data["content_checksum"]:
+    # Version 1 files don't record the algorithm; they always used MD5.
+    if data["version"] >= 2:
+        MagmaIOError.assert_has_key(data, "content_checksum_algorithm", str)
+        algorithm = data["content_checksum_algorithm"]
+    else:
+        algorithm = "md5"
+
+    try:
+        checksum = magmabuffer._get_content_checksum(algorithm)
+    except (ImportError, MagmaException):
+        raise MagmaIOError(f"Unsupported checksum algorithm: {algorithm}")
+    if checksum != data["content_checksum"]:
         raise MagmaIOError("Buffer contents' checksum does not match!")
 
-    MagmaIOError.assert_has_key(data, "cells", list)
-    for cell in data["cells"]:
-        MagmaIOError.assert_has_key(cell, "span", dict)
-        MagmaIOError.assert_has_key(cell["span"], "begin", dict)
-        MagmaIOError.assert_has_key(cell["span"]["begin"], "lineno", int)
-        MagmaIOError.assert_has_key(cell["span"]["begin"], "colno", int)
-        MagmaIOError.assert_has_key(cell["span"], "end", dict)
-        MagmaIOError.assert_has_key(cell["span"]["end"], "lineno", int)
-        MagmaIOError.assert_has_key(cell["span"]["end"], "colno", int)
+    # `assert_has_key` returns the value it checked, so each key is looked up
+    # only once.
+    assert_has_key = MagmaIOError.assert_has_key
+    make_output_chunk = magmabuffer.runtime.make_output_chunk
+    nvim = magmabuffer.nvim
+    extmark_namespace = magmabuffer.extmark_namespace
+    bufno = magmabuffer.buffer.number
+    extmark_pool = magmabuffer.extmark_pool
+    cells: List[Tuple[Span, Output]] = []
+    for cell in assert_has_key(data, "cells", list):
+        cell_span = assert_has_key(cell, "span", dict)
+        begin = assert_has_key(cell_span, "begin", dict)
+        end = assert_has_key(cell_span, "end", dict)
         begin_position = DynamicPosition(
-            magmabuffer.nvim,
-            magmabuffer.extmark_namespace,
-            magmabuffer.buffer.number,
-            cell["span"]["begin"]["lineno"],
-            cell["span"]["begin"]["colno"],
+            nvim,
+            extmark_namespace,
+            bufno,
+            assert_has_key(begin, "lineno", int),
+            assert_has_key(begin, "colno", int),
+            pool=extmark_pool,
         )
         end_position = DynamicPosition(
-            magmabuffer.nvim,
-            magmabuffer.extmark_namespace,
-            magmabuffer.buffer.number,
-            cell["span"]["end"]["lineno"],
-            cell["span"]["end"]["colno"],
+            nvim,
+            extmark_namespace,
+            bufno,
+            assert_has_key(end, "lineno", int),
+            assert_has_key(end, "colno", int),
+            pool=extmark_pool,
         )
         span = Span(begin_position, end_position)
 
         # XXX: do we really want to have the execution count here?
         #      what happens when the counts start to overlap?
-        MagmaIOError.assert_has_key(cell, "execution_count", int)
-        output = Output(cell["execution_count"])
-
-        MagmaIOError.assert_has_key(cell, "status", int)
-        output.status = OutputStatus(cell["status"])
-
-        MagmaIOError.assert_has_key(cell, "success", bool)
-        output.success = cell["success"]
-
-        MagmaIOError.assert_has_key(cell, "chunks", list)
-        for chunk in cell["chunks"]:
-            MagmaIOError.assert_has_key(chunk, "data", dict)
-            MagmaIOError.assert_has_key(chunk, "metadata", dict)
-            output.chunks.append(
-                to_outputchunk(
-                    magmabuffer.runtime._alloc_file,
-                    chunk["data"],
-                    chunk["metadata"],
-                )
+        output = Output(assert_has_key(cell, "execution_count", int))
+        output.status = OutputStatus(assert_has_key(cell, "status", int))
+        output.success = assert_has_key(cell, "success", bool)
+
+        output.chunks.extend(
+            make_output_chunk(
+                assert_has_key(chunk, "data", dict),
+                assert_has_key(chunk, "metadata", dict),
             )
+            for chunk in assert_has_key(cell, "chunks", list)
+        )
 
         output.old = True
 
-        magmabuffer.outputs[span] = OutputBuffer(
-            magmabuffer.nvim, magmabuffer.canvas, magmabuffer.options
-        )
+        cells.append((span, output))
+
+    # Cells must not overlap (see `MagmaBuffer.add_output`), but older
+    # versions didn't ensure that when defining them, so the last one wins,
+    # as it would if the cells were defined now. That includes the cells
+    # which were already there, which come before all of the loaded ones.
+    get_position = magmabuffer._get_position_getter()
+    kept: List[Tuple[Tuple[int, int], Tuple[int, int]]] = []
+    surviving: List[Span] = []
+    all_spans = list(magmabuffer.outputs.keys()) + [span for span, _ in cells]
+    for span in reversed(all_spans):
+        begin_tuple = get_position(span.begin)
+        end_tuple = get_position(span.end)
+        if not any(
+            _overlaps(begin_tuple, end_tuple, kept_begin, kept_end)
+            for kept_begin, kept_end in kept
+        ):
+            kept.append((begin_tuple, end_tuple))
+            surviving.append(span)
+    surviving_spans = set(surviving)
+
+    for span in list(magmabuffer.outputs.keys()):
+        if span not in surviving_spans:
+            magmabuffer.outputs[span].clear_interface()
+            magmabuffer._remove_output(span)
+
+    for span, output in cells:
+        if span in surviving_spans:
+            magmabuffer.add_output(
+                span,
+                OutputBuffer(
+                    magmabuffer.nvim, magmabuffer.canvas, magmabuffer.options
+                ),
+            )
+
+
+def _overlaps(
+    begin: Tuple[int, int],
+    end: Tuple[int, int],
+    other_begin: Tuple[int, int],
+    other_end: Tuple[int, int],
+) -> bool:
+    # The same check as in `MagmaBuffer._delete_all_cells_in_span`.
+    return (
+        begin <= other_begin < end
+        or begin <= other_end < end
+        or other_begin <= begin < other_end
+        or other_begin <= end < other_end
+    )
 
 
 def save(magmabuffer: MagmaBuffer) -> Dict[str, Any]:
-    return {
-        "version": 1,
-        "kernel": magmabuffer.runtime.kernel_name,
-        "content_checksum": magmabuffer._get_content_checksum(),
-        "cells": [
+    cells = []
+    for span, output_buffer in magmabuffer.outputs.items():
+        output = output_buffer.output
+        chunks = []
+        for chunk in output.chunks:
+            data = chunk.jupyter_data
+            metadata = chunk.jupyter_metadata
+            if data is not None and metadata is not None:
+                chunks.append({"data": data, "metadata": metadata})
+        # Each position is fetched with a single RPC.
+        begin_lineno, begin_colno = span.begin.to_tuple()
+        end_lineno, end_colno = span.end.to_tuple()
+        cells.append(
             {
                 "span": {
-                    "begin": {
-                        "lineno": span.begin.lineno,
-                        "colno": span.begin.colno,
-                    },
-                    "end": {
-                        "lineno": span.end.lineno,
-                        "colno": span.end.colno,
-                    },
+                    "begin": {"lineno": begin_lineno, "colno": begin_colno},
+                    "end": {"lineno": end_lineno, "colno": end_colno},
                 },
-                "execution_count": output.output.execution_count,
-                "status": output.output.status.value,
-                "success": output.output.success,
-                "chunks": [
-                    {
-                        "data": chunk.jupyter_data,
-                        "metadata": chunk.jupyter_metadata,
-                    }
-                    for chunk in output.output.chunks
-                    if chunk.jupyter_data is not None
-                    and chunk.jupyter_metadata is not None
-                ],
+                "execution_count": output.execution_count,
+                "status": output.status.value,
+                "success": output.success,
+                "chunks": chunks,
             }
-            for span, output in magmabuffer.outputs.items()
-        ],
+        )
+
+    return {
+        "version": 2,
+        "kernel": magmabuffer.runtime.kernel_name,
+        "content_checksum": magmabuffer._get_content_checksum(),
+        "content_checksum_algorithm": CHECKSUM_ALGORITHM,
+        "cells": cells,
     }
+
+
+def dump(data: Dict[str, Any], path: str) -> None:
+    # orjson is considerably faster (and serializes straight to bytes), which
+    # matters when there are big images in the outputs; it is optional,
+    # though. It is also stricter than `json` (e.g., about integers beyond 64
+    # bits), so anything it rejects goes through `json` instead.
+    try:
+        import orjson
+    except ImportError:
+        with open(path, "w") as file:
+            json.dump(data, file)
+        return
+
+    try:
+        serialized = orjson.dumps(data)
+    except orjson.JSONEncodeError:
+        serialized = json.dumps(data).encode()
+
+    with open(path, "wb") as file:
+        file.write(serialized)
+
+
+def read_dump(path: str) -> Any:
+    # See `dump`. This includes NaN and Infinity, which `json` writes but
+    # orjson doesn't read.
+    try:
+        import orjson
+    except ImportError:
+        with open(path) as file:
+            return json.load(file)
+
+    with open(path, "rb") as file:
+        content = file.read()
+
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return json.loads(content)
@@ -1,5 +1,5 @@
-from typing import Optional, Dict
-from queue import Queue
+from typing import Optional, Dict, List, Tuple, Any, Callable
+from collections import deque
 import hashlib
 
 import pynvim
@@ -8,24 +8,46 @@ from pynvim.api import Buffer
 
 from magma.options import MagmaOptions
 from magma.images import Canvas
-from magma.utils import MagmaException, Position, Span
+from magma.utils import MagmaException, Position, DynamicPosition, Span
 from magma.outputbuffer import OutputBuffer
 from magma.outputchunks import OutputStatus
 from magma.runtime import JupyterRuntime
 
 
+# Lua helpers, defined once (see `Magma._initialize`) so that they don't have
+# to be sent and compiled on every call.
+LUA_HELPERS = """
+function MagmaGetWindowState()
+    local window = vim.api.nvim_get_current_win()
+    local cursor = vim.api.nvim_win_get_cursor(window)
+    return {
+        vim.api.nvim_get_current_buf(),
+        vim.api.nvim_win_get_buf(window),
+        cursor[1] - 1,
+        cursor[2],
+        vim.fn.line("w0"),
+        vim.api.nvim_win_get_position(window)[2],
+        vim.api.nvim_win_get_width(window),
+        vim.api.nvim_win_get_height(window),
+    }
+end
+"""
+
+
 class MagmaBuffer:
     nvim: Nvim
     canvas: Canvas
     highlight_namespace: int
     extmark_namespace: int
     buffer: Buffer
+    extmark_pool: List[int]
 
     runtime: JupyterRuntime
 
     outputs: Dict[Span, OutputBuffer]
+    span_index: List[Span]
     current_output: Optional[Span]
-    queued_outputs: "Queue[Span]"
+    queued_outputs: "deque[Span]"
 
     selected_cell: Optional[Span]
     should_open_display_window: bool
@@ -33,6 +55,29 @@ class MagmaBuffer:
 
     options: MagmaOptions
 
+    # What the interface was last drawn for, if it hasn't been cleared since.
+    _shown_interface: Optional[Tuple[Optional[Span], bool, Any]]
+    # Incremented whenever what is shown becomes outdated (see
+    # `invalidate_interface`), so that an update which was waiting on an RPC
+    # in the meantime doesn't record what it drew as current.
+    _interface_generation: int
+
+    _checksum_cache: Optional[Tuple[int, str, str]]
+    _tick_scheduled: bool
+    # Whether a cell is currently highlighted.
+    _highlight_shown: bool
+    _update_interface_scheduled: bool
+    # Whether `update_interface` is running (and possibly waiting on an RPC,
+    # during which other requests are handled), and whether another update
+    # was requested meanwhile, to be done once it is finished.
+    _update_interface_running: bool
+    _update_interface_pending: bool
+
+    # Bound RPC functions used in hot paths, looked up only once
+    _getcurpos: Callable[..., Any]
+    _buf_clear_namespace: Callable[..., Any]
+    _call_atomic: Callable[..., Any]
+
     def __init__(
         self,
         nvim: Nvim,
@@ -48,21 +93,41 @@ class MagmaBuffer:
         self.highlight_namespace = highlight_namespace
         self.extmark_namespace = extmark_namespace
         self.buffer = buffer
+        self.extmark_pool = []
 
         self._doautocmd("MagmaInitPre")
 
-        self.runtime = JupyterRuntime(kernel_name, options)
+        self._tick_scheduled = False
+        self._highlight_shown = False
+        self._update_interface_scheduled = False
+        self._update_interface_running = False
+        self._update_interface_pending = False
+        self.runtime = JupyterRuntime(
+            kernel_name,
+            options,
+            on_iopub_message=self._on_iopub_message,
+            on_iopub_error=self._on_iopub_error,
+        )
 
         self.outputs = {}
+        self.span_index = []
         self.current_output = None
-        self.queued_outputs = Queue()
+        self.queued_outputs = deque()
 
         self.selected_cell = None
         self.should_open_display_window = False
         self.updating_interface = False
+        self._shown_interface = None
+        self._interface_generation = 0
 
         self.options = options
 
+        self._checksum_cache = None
+
+        self._getcurpos = nvim.funcs.getcurpos
+        self._buf_clear_namespace = nvim.api.buf_clear_namespace
+        self._call_atomic = nvim.api.call_atomic
+
         self._doautocmd("MagmaInitPost")
 
     def _doautocmd(self, autocmd: str) -> None:
@@ -72,15 +137,26 @@ class MagmaBuffer:
     def deinit(self) -> None:
         self._doautocmd("MagmaDeinitPre")
         self.runtime.deinit()
+        self._clear_extmarks()
         self._doautocmd("MagmaDeinitPost")
 
+    def _clear_extmarks(self) -> None:
+        # The extmarks of positions given back to the pool are kept around
+        # (see `DynamicPosition`), so they have to be deleted at some point.
+        self._buf_clear_namespace(
+            self.buffer.number, self.extmark_namespace, 0, -1
+        )
+        self.extmark_pool.clear()
+
     def interrupt(self) -> None:
         self.runtime.interrupt()
 
     def restart(self, delete_outputs: bool = False) -> None:
         if delete_outputs:
             self.outputs = {}
+            self.span_index = []
             self.clear_interface()
+            self._clear_extmarks()
 
         self.runtime.restart()
 
@@ -90,19 +166,21 @@ class MagmaBuffer:
 
         if span in self.outputs:
             self.outputs[span].clear_interface()
-            del self.outputs[span]
+            self._remove_output(span)
 
-        self.outputs[span] = OutputBuffer(self.nvim, self.canvas, self.options)
-        self.queued_outputs.put(span)
+        self.add_output(
+            span, OutputBuffer(self.nvim, self.canvas, self.options)
+        )
+        self.queued_outputs.append(span)
 
-        self.selected_cell = span
+        self._select_cell(span)
         self.should_open_display_window = True
-        self.update_interface()
+        self.update_interface(selected_hint=span)
 
         self._check_if_done_running()
 
     def reevaluate_cell(self) -> None:
-        self.selected_cell = self._get_selected_span()
+        self._select_cell(self._get_selected_span())
         if self.selected_cell is None:
             raise MagmaException("Not in a cell")
 
@@ -111,18 +189,16 @@ class MagmaBuffer:
         self.run_code(code, self.selected_cell)
 
     def _check_if_done_running(self) -> None:
-        # TODO: refactor
-        is_idle = ( self.current_output is None
-            or not self.current_output in self.outputs
-        ) or ( self.current_output is not None
-            and self.outputs[self.current_output].output.status
-            == OutputStatus.DONE
+        current = (
+            self.outputs.get(self.current_output)
+            if self.current_output is not None
+            else None
         )
-        if is_idle and not self.queued_outputs.empty():
-            key = self.queued_outputs.get_nowait()
-            self.current_output = key
+        is_idle = current is None or current.output.status == OutputStatus.DONE
+        if is_idle and self.queued_outputs:
+            self.current_output = self.queued_outputs.popleft()
 
-    def tick(self) -> None:
+    def tick(self, update_interface: bool = True) -> None:
         self._check_if_done_running()
 
         was_ready = self.runtime.is_ready()
@@ -133,7 +209,10 @@ class MagmaBuffer:
                 self.outputs[self.current_output].output
             )
         if did_stuff:
-            self.update_interface()
+            # The output may have changed, so it has to be redrawn.
+            self.invalidate_interface()
+            if update_interface:
+                self._schedule_update_interface()
         if not was_ready and self.runtime.is_ready():
             self.nvim.api.notify(
                 "Kernel '%s' is ready." % self.runtime.kernel_name,
@@ -141,127 +220,422 @@ class MagmaBuffer:
                 {"title": "Magma"},
             )
 
+    def _on_iopub_message(self) -> None:
+        # This is called from the runtime's IOPub thread, so hand over to the
+        # main loop; several messages arriving at once only cause one tick.
+        if not self._tick_scheduled:
+            self._tick_scheduled = True
+            self.nvim.async_call(self._tick_on_iopub_message)
+
+    def _on_iopub_error(self, message: str) -> None:
+        # Also called from the runtime's IOPub thread.
+        self.nvim.async_call(self.nvim.err_write, f"[Magma] {message}\n")
+
+    def _tick_on_iopub_message(self) -> None:
+        self._tick_scheduled = False
+        self.tick()
+
+    def _schedule_update_interface(self) -> None:
+        # Several ticks in a row (e.g. while output is streaming in) only
+        # cause a single redraw.
+        if not self._update_interface_scheduled:
+            self._update_interface_scheduled = True
+            self.nvim.async_call(self._do_scheduled_update_interface)
+
+    def _do_scheduled_update_interface(self) -> None:
+        self._update_interface_scheduled = False
+        self.update_interface()
+
     def enter_output(self) -> None:
         if self.selected_cell is not None:
             self.outputs[self.selected_cell].enter()
 
     def _get_cursor_position(self) -> Position:
-        _, lineno, colno, _, _ = self.nvim.funcs.getcurpos()
-        return Position(self.nvim.current.buffer.number, lineno - 1, colno - 1)
+        _, lineno, colno, _, _ = self._getcurpos()
+        return Position(self.buffer.number, lineno - 1, colno - 1)
 
     def clear_interface(self) -> None:
         if self.updating_interface:
             return
 
-        self.nvim.funcs.nvim_buf_clear_namespace(
-            self.buffer.number,
-            self.highlight_namespace,
-            0,
-            -1,
-        )
+        if self._highlight_shown:
+            self._buf_clear_namespace(
+                self.buffer.number,
+                self.highlight_namespace,
+                0,
+                -1,
+            )
+            self._highlight_shown = False
+        self._clear_outputs()
+
+    def _clear_outputs(self, keep_window: bool = False) -> None:
+        """
+        Clear everything in the interface but the highlight.
+
+        If `keep_window`, the output window is left open, so that it can be
+        moved instead of being opened again.
+        """
+
+        self._shown_interface = None
+
         # and self.nvim.funcs.winbufnr(self.display_window) != -1:
-        if self.selected_cell is not None and self.selected_cell in self.outputs:
+        if (
+            not keep_window
+            and self.selected_cell is not None
+            and self.selected_cell in self.outputs
+        ):
             self.outputs[self.selected_cell].clear_interface()
         self.canvas.clear()
 
-    def _get_selected_span(self) -> Optional[Span]:
-        current_position = self._get_cursor_position()
-        selected = None
-        for span in reversed(self.outputs.keys()):
-            if current_position in span:
-                selected = span
-                break
+    def _bisect_span_index(self, position: Position) -> int:
+        """
+        Return the number of spans in `span_index` which begin at or before
+        `position`.
+        """
+
+        low, high = 0, len(self.span_index)
+        while low < high:
+            middle = (low + high) // 2
+            if self.span_index[middle].begin <= position:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def add_output(self, span: Span, output: OutputBuffer) -> None:
+        """
+        Add an output for the given span.
+
+        The span must not overlap with the spans of any other outputs (see
+        `_delete_all_cells_in_span`).
+        """
 
-        return selected
+        if span in self.outputs:
+            self._remove_output(span)
+
+        self.outputs[span] = output
+        self.span_index.insert(self._bisect_span_index(span.begin), span)
+        self.invalidate_interface()
+
+    def _remove_output(self, span: Span) -> None:
+        del self.outputs[span]
+        self.span_index.remove(span)
+        self.invalidate_interface()
+
+    def _get_selected_span(
+        self, current_position: Optional[Position] = None
+    ) -> Optional[Span]:
+        if current_position is None:
+            current_position = self._get_cursor_position()
+
+        # Spans don't overlap, and extmarks keep their relative order when the
+        # buffer is edited, so `span_index` stays sorted and only the last span
+        # beginning before the cursor can contain it.
+        index = self._bisect_span_index(current_position)
+        if index == 0:
+            return None
+
+        # The bisection already established that the span begins at or before
+        # the cursor, so only its end needs to be checked.
+        span = self.span_index[index - 1]
+        if current_position < span.end:
+            return span
+        else:
+            return None
+
+    def _get_position_getter(self) -> Callable[[Position], Tuple[int, int]]:
+        """
+        Return a function giving the current line and column of a position,
+        which (for the positions of this buffer) only uses the positions of
+        all of the extmarks, fetched here with a single RPC.
+        """
+
+        extmarks = self.nvim.api.buf_get_extmarks(
+            self.buffer.number, self.extmark_namespace, 0, -1, {}
+        )
+        positions = {
+            extmark_id: (lineno, colno)
+            for extmark_id, lineno, colno in extmarks
+        }
+
+        def get_position(position: Position) -> Tuple[int, int]:
+            if isinstance(position, DynamicPosition):
+                maybe_position = positions.get(position.extmark_id)
+                if maybe_position is not None:
+                    return maybe_position
+            return position.to_tuple()
+
+        return get_position
 
     def _delete_all_cells_in_span(self, span: Span) -> None:
+        get_position = self._get_position_getter()
+        begin = get_position(span.begin)
+        end = get_position(span.end)
         for output_span in reversed(list(self.outputs.keys())):
+            output_begin = get_position(output_span.begin)
+            output_end = get_position(output_span.end)
             if (
-                output_span.begin in span
-                or output_span.end in span
-                or span.begin in output_span
-                or span.end in output_span
+                begin <= output_begin < end
+                or begin <= output_end < end
+                or output_begin <= begin < output_end
+                or output_begin <= end < output_end
             ):
                 self.outputs[output_span].clear_interface()
-                del self.outputs[output_span]
+                self._remove_output(output_span)
+
+    def _select_cell(self, span: Optional[Span]) -> None:
+        # The output of the previously selected cell may still be shown (e.g.,
+        # if the cursor left it before the interface got updated), and
+        # `update_interface` only knows about the newly selected one.
+        if (
+            self.selected_cell is not None
+            and self.selected_cell != span
+            and self.selected_cell in self.outputs
+        ):
+            self.outputs[self.selected_cell].clear_interface()
+        self.selected_cell = span
 
     def delete_cell(self) -> None:
-        self.selected_cell = self._get_selected_span()
+        self._select_cell(self._get_selected_span())
         if self.selected_cell is None:
             return
 
         self.outputs[self.selected_cell].clear_interface()
-        del self.outputs[self.selected_cell]
+        self._remove_output(self.selected_cell)
 
-    def update_interface(self) -> None:
-        if self.buffer.number != self.nvim.current.buffer.number:
-            return
-        if self.buffer.number != self.nvim.current.window.buffer.number:
-            return
+    def invalidate_interface(self) -> None:
+        """
+        Make the next `update_interface` redraw everything, even if an update
+        is already under way.
+        """
 
-        self.clear_interface()
+        self._shown_interface = None
+        self._interface_generation += 1
 
-        self.updating_interface = True
+    def update_interface(self, selected_hint: Optional[Span] = None) -> None:
+        """
+        Redraw the interface, if necessary.
 
-        selected_cell = self._get_selected_span()
+        `selected_hint` is a span which the caller expects to be selected; if
+        the cursor is in it, looking up the selected span is skipped.
+        """
+
+        # Rather than drawing into a half-finished interface, an update
+        # requested while another is running is done after it.
+        if self._update_interface_running:
+            self._update_interface_pending = True
+            return
+
+        self._update_interface_running = True
+        try:
+            self._update_interface(selected_hint)
+        finally:
+            self._update_interface_running = False
+
+        if self._update_interface_pending:
+            self._update_interface_pending = False
+            self._schedule_update_interface()
+
+    def _update_interface(self, selected_hint: Optional[Span]) -> None:
+        generation = self._interface_generation
+        (
+            current_bufno,
+            window_bufno,
+            cursor_lineno,
+            cursor_colno,
+            *view,
+        ) = self._get_window_state()
+        if self.buffer.number != current_bufno:
+            return
+        if self.buffer.number != window_bufno:
+            return
+
+        cursor_position = Position(
+            self.buffer.number, cursor_lineno, cursor_colno
+        )
+        if (
+            selected_hint is not None
+            and selected_hint in self.outputs
+            and cursor_position in selected_hint
+        ):
+            selected_cell: Optional[Span] = selected_hint
+        else:
+            selected_cell = self._get_selected_span(cursor_position)
 
         if self.options.automatically_open_output:
-            self.should_open_display_window = True
+            should_open_display_window = True
+        elif self.selected_cell != selected_cell:
+            should_open_display_window = False
         else:
-            if self.selected_cell != selected_cell:
-                self.should_open_display_window = False
+            should_open_display_window = self.should_open_display_window
+
+        # The highlight depends on where the cell is, and the output window is
+        # also placed relative to the view.
+        if selected_cell is None:
+            layout = None
+        elif should_open_display_window:
+            layout = (
+                selected_cell.begin.to_tuple(),
+                selected_cell.end.to_tuple(),
+                view,
+            )
+        else:
+            layout = (
+                selected_cell.begin.to_tuple(),
+                selected_cell.end.to_tuple(),
+                None,
+            )
+
+        # If nothing changed since the interface was last drawn (e.g., the
+        # cursor just moved within the same cell), there's nothing to do.
+        shown_interface = (selected_cell, should_open_display_window, layout)
+        if shown_interface == self._shown_interface:
+            return
+
+        # The highlight is cleared along with being redrawn, in
+        # `_show_selected`; if the same output window is going to be shown
+        # again, it is kept open.
+        self._clear_outputs(
+            keep_window=selected_cell is not None
+            and selected_cell == self.selected_cell
+            and selected_cell in self.outputs
+            and should_open_display_window
+            and self.should_open_display_window
+        )
+
+        self.updating_interface = True
 
+        self.should_open_display_window = should_open_display_window
         self.selected_cell = selected_cell
 
-        if self.selected_cell is not None:
-            self._show_selected(self.selected_cell)
+        self._show_selected(
+            self.selected_cell,
+            layout[0] if layout is not None else None,
+            layout[1] if layout is not None else None,
+            view,
+        )
         self.canvas.present()
 
+        if self._interface_generation == generation:
+            self._shown_interface = shown_interface
         self.updating_interface = False
 
-    def _show_selected(self, span: Span) -> None:
-        if span.begin.lineno == span.end.lineno:
-            self.nvim.funcs.nvim_buf_add_highlight(
-                self.buffer.number,
-                self.highlight_namespace,
-                self.options.cell_highlight_group,
-                span.begin.lineno,
-                span.begin.colno,
-                span.end.colno,
-            )
-        else:
-            self.nvim.funcs.nvim_buf_add_highlight(
-                self.buffer.number,
-                self.highlight_namespace,
-                self.options.cell_highlight_group,
-                span.begin.lineno,
-                span.begin.colno,
-                -1,
-            )
-            for lineno in range(span.begin.lineno + 1, span.end.lineno):
-                self.nvim.funcs.nvim_buf_add_highlight(
-                    self.buffer.number,
-                    self.highlight_namespace,
-                    self.options.cell_highlight_group,
-                    lineno,
-                    0,
-                    -1,
-                )
-            self.nvim.funcs.nvim_buf_add_highlight(
-                self.buffer.number,
-                self.highlight_namespace,
-                self.options.cell_highlight_group,
-                span.end.lineno,
-                0,
-                span.end.colno,
-            )
+    def _get_window_state(self) -> List[int]:
+        """
+        Get, in a single RPC: the current buffer, the current window's buffer,
+        the (0-indexed) cursor line and column, and the view, i.e., the first
+        line shown, column, width and height of the current window.
+        """
 
-        if self.should_open_display_window:
-            self.outputs[span].show(span.end)
+        state: List[int] = self.nvim.lua.MagmaGetWindowState()
+        return state
 
-    def _get_content_checksum(self) -> str:
-        return hashlib.md5(
-            "\n".join(
-                self.nvim.current.buffer.api.get_lines(0, -1, True)
-            ).encode("utf-8")
-        ).hexdigest()
+    def _show_selected(
+        self,
+        span: Optional[Span],
+        begin: Optional[Tuple[int, int]],
+        end: Optional[Tuple[int, int]],
+        view: List[int],
+    ) -> None:
+        """
+        Replace the highlight with that of `span` (if any), whose begin and
+        end positions are given, and show its output if it should be shown.
+        """
+
+        # Clearing the old highlight and setting the new one is a single RPC;
+        # the highlight itself is a single ranged extmark, rather than one
+        # `nvim_buf_add_highlight` per line.
+        calls: List[List[Any]] = [
+            [
+                "nvim_buf_clear_namespace",
+                [self.buffer.number, self.highlight_namespace, 0, -1],
+            ]
+        ]
+        if span is not None:
+            assert begin is not None and end is not None
+            calls.append(
+                [
+                    "nvim_buf_set_extmark",
+                    [
+                        self.buffer.number,
+                        self.highlight_namespace,
+                        begin[0],
+                        begin[1],
+                        {
+                            "end_line": end[0],
+                            "end_col": end[1],
+                            "hl_group": self.options.cell_highlight_group,
+                        },
+                    ],
+                ]
+            )
+        _, error = self._call_atomic(calls)
+        if error is not None:
+            raise MagmaException(f"Failed to highlight cell: {error[2]}")
+        self._highlight_shown = span is not None
+
+        if span is not None and self.should_open_display_window:
+            self.outputs[span].show(Position(self.buffer.number, *end), view)
+
+    def _get_content_checksum(self, algorithm: Optional[str] = None) -> str:
+        algorithm = algorithm or CHECKSUM_ALGORITHM
+
+        # `b:changedtick` changes whenever the buffer does, so if it is the
+        # same as last time there's no need to hash the buffer again.
+        changedtick = self.buffer.api.get_changedtick()
+        if self._checksum_cache is not None:
+            cached_tick, cached_algorithm, checksum = self._checksum_cache
+            if cached_tick == changedtick and cached_algorithm == algorithm:
+                return checksum
+
+        hasher = get_checksum_hasher(algorithm)
+        # The lines are fetched along with the tick they correspond to, in a
+        # single atomic call, so that the cached checksum can't be for a
+        # different version of the buffer than its tick says.
+        (changedtick, lines), error = self._call_atomic(
+            [
+                ["nvim_buf_get_changedtick", [self.buffer.number]],
+                ["nvim_buf_get_lines", [self.buffer.number, 0, -1, True]],
+            ]
+        )
+        if error is not None:
+            raise MagmaException(f"Failed to read buffer: {error[2]}")
+        # Feed the lines in blocks, rather than hashing a single big joined
+        # string (which would copy the whole buffer) or each line on its own
+        # (which makes many small calls); the digest is the same as that of
+        # `"\n".join(lines)`.
+        for start in range(0, len(lines), CHECKSUM_BLOCK_LINES):
+            if start > 0:
+                hasher.update(b"\n")
+            block = lines[start : start + CHECKSUM_BLOCK_LINES]
+            hasher.update("\n".join(block).encode("utf-8"))
+        checksum: str = hasher.hexdigest()
+
+        self._checksum_cache = (changedtick, algorithm, checksum)
+        return checksum
+
+
+CHECKSUM_BLOCK_LINES = 4096
+
+
+def get_checksum_hasher(algorithm: str) -> Any:
+    if algorithm == "blake3":
+        import blake3
+
+        return blake3.blake3()
+    elif algorithm == "xxh3":
+        import xxhash
+
+        return xxhash.xxh3_64()
+    elif algorithm == "blake2b":
+        return hashlib.blake2b()
+    elif algorithm == "md5":
+        return hashlib.md5()
+    else:
+        raise MagmaException(f"Unknown checksum algorithm: '{algorithm}'")
+
+
+# The checksum is saved along with the outputs, so it must be computable
+# wherever they may be loaded: blake2b is fast, and in the standard library.
+# (Other algorithms are still accepted when loading.)
+CHECKSUM_ALGORITHM = "blake2b"
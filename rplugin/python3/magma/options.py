@@ -3,7 +3,32 @@ import os
 from pynvim import Nvim
 
 
+_OPTION_VARIABLES = [
+    "magma_automatically_open_output",
+    "magma_wrap_output",
+    "magma_output_window_borders",
+    "magma_show_mimetype_debug",
+    "magma_cell_highlight_group",
+    "magma_save_cell",
+    "magma_image_provider",
+    "magma_copy_output",
+]
+
+
 class MagmaOptions:
+    # Options are read on hot paths (e.g. every redraw), and slots make those
+    # reads a bit cheaper.
+    __slots__ = (
+        "automatically_open_output",
+        "wrap_output",
+        "output_window_borders",
+        "show_mimetype_debug",
+        "cell_highlight_group",
+        "save_path",
+        "image_provider",
+        "copy_output",
+    )
+
     automatically_open_output: bool
     wrap_output: bool
     output_window_borders: bool
@@ -14,24 +39,37 @@ class MagmaOptions:
     copy_output: bool
 
     def __init__(self, nvim: Nvim):
-        self.automatically_open_output = nvim.vars.get(
+        # Read all of the `g:magma_*` variables in a single round-trip,
+        # instead of doing one RPC per option.
+        values, data_path = nvim.exec_lua(
+            """
+            local values = vim.empty_dict()
+            for _, name in ipairs(...) do
+                values[name] = vim.g[name]
+            end
+            return {values, vim.fn.stdpath("data")}
+            """,
+            _OPTION_VARIABLES,
+        )
+
+        self.automatically_open_output = values.get(
             "magma_automatically_open_output", True
         )
-        self.wrap_output = nvim.vars.get("magma_wrap_output", False)
-        self.output_window_borders = nvim.vars.get(
+        self.wrap_output = values.get("magma_wrap_output", False)
+        self.output_window_borders = values.get(
             "magma_output_window_borders", True
         )
-        self.show_mimetype_debug = nvim.vars.get(
+        self.show_mimetype_debug = values.get(
             "magma_show_mimetype_debug", False
         )
-        self.cell_highlight_group = nvim.vars.get(
+        self.cell_highlight_group = values.get(
             "magma_cell_highlight_group", "CursorLine"
         )
-        self.save_path = nvim.vars.get(
+        self.save_path = values.get(
             "magma_save_cell",
-            os.path.join(nvim.funcs.stdpath("data"), "magma"),
+            os.path.join(data_path, "magma"),
         )
-        self.image_provider = nvim.vars.get("magma_image_provider", "none")
-        self.copy_output = nvim.vars.get(
+        self.image_provider = values.get("magma_image_provider", "none")
+        self.copy_output = values.get(
             "magma_copy_output", False
         )
@@ -1,4 +1,5 @@
-from typing import Optional
+from typing import Any, Optional, List
+from functools import lru_cache
 
 from pynvim import Nvim
 from pynvim.api import Buffer
@@ -6,7 +7,7 @@ from pynvim.api import Buffer
 from magma.images import Canvas
 from magma.outputchunks import Output, OutputStatus
 from magma.options import MagmaOptions
-from magma.utils import Position
+from magma.utils import MagmaException, Position
 
 
 class OutputBuffer:
@@ -33,35 +34,13 @@ class OutputBuffer:
 
         self.options = options
 
-    def _buffer_to_window_lineno(self, lineno: int) -> int:
-        win_top = self.nvim.funcs.line("w0")
-        assert isinstance(win_top, int)
+    def _buffer_to_window_lineno(self, lineno: int, win_top: int) -> int:
         return lineno - win_top + 1
 
     def _get_header_text(self, output: Output) -> str:
-        if output.execution_count is None:
-            execution_count = "..."
-        else:
-            execution_count = str(output.execution_count)
-
-        if output.status == OutputStatus.HOLD:
-            status = "* On Hold"
-        elif output.status == OutputStatus.DONE:
-            if output.success:
-                status = "✓ Done"
-            else:
-                status = "✗ Failed"
-        elif output.status == OutputStatus.RUNNING:
-            status = "... Running"
-        else:
-            raise ValueError("bad output.status: %s" % output.status)
-
-        if output.old:
-            old = "[OLD] "
-        else:
-            old = ""
-
-        return f"{old}Out[{execution_count}]: {status}"
+        return _get_header_text(
+            output.execution_count, output.status, output.success, output.old
+        )
 
     def enter(self) -> None:
         if self.display_window is not None:  # TODO open window if is None?
@@ -72,66 +51,134 @@ class OutputBuffer:
             self.nvim.funcs.nvim_win_close(self.display_window, True)
             self.display_window = None
 
-    def show(self, anchor: Position) -> None:  # XXX .show_outputs(_, anchor)
+    def show(self, anchor: Position, view: List[int]) -> None:
+        """
+        `view` is the first line shown, column, width and height of the
+        current window (see `MagmaBuffer._get_window_state`).
+        """
+
+        # XXX .show_outputs(_, anchor)
         # FIXME use `anchor.buffer`, Not `self.nvim.current.window`
 
         # Get width&height, etc
-        win_col = self.nvim.current.window.col
-        win_row = self._buffer_to_window_lineno(anchor.lineno + 1)
-        win_width = self.nvim.current.window.width
-        win_height = self.nvim.current.window.height
-        if self.options.output_window_borders:
+        win_top, win_col, win_width, win_height = view
+        win_row = self._buffer_to_window_lineno(anchor.lineno + 1, win_top)
+        options = self.options
+        borders = options.output_window_borders
+        if borders:
             win_height -= 2
 
-        # Clear buffer:
-        self.nvim.funcs.deletebufline(self.display_buffer.number, 1, "$")
         # Add output chunks to buffer
-        lines_str = ""
+        chunktexts = []
         lineno = 0
         shape = (win_col, win_row, win_width, win_height)
         if len(self.output.chunks) > 0:
+            canvas = self.canvas
+            append_chunktext = chunktexts.append
             for chunk in self.output.chunks:
-                chunktext = chunk.place(
-                    self.options, lineno, shape, self.canvas
-                )
-                lines_str += chunktext
+                chunktext = chunk.place(options, lineno, shape, canvas)
+                append_chunktext(chunktext)
                 lineno += chunktext.count("\n")
-            lines = lines_str.rstrip().split("\n")
-            actualLines = []
-            for line in lines:
-                parts = line.split('\r')
-                last = parts[-1]
-                if last != "":
-                    actualLines.append(last)
-            lines = actualLines
+            # Only what comes after the last carriage return of each line is
+            # shown, and then only if it isn't empty.
+            lines = [
+                last
+                for line in "".join(chunktexts).rstrip().split("\n")
+                if (last := line.rpartition("\r")[2]) != ""
+            ]
             lineno = len(lines)
         else:
-            lines = [lines_str]
-        self.display_buffer[0] = self._get_header_text(self.output)  # TODO
-        self.display_buffer.append(lines)
-
-        # Open output window
-        assert self.display_window is None
-        if win_row < win_height:
-            self.display_window = self.nvim.funcs.nvim_open_win(
-                self.display_buffer.number,
-                False,
-                {
-                    "relative": "win",
-                    "col": 0,
-                    "row": win_row,
-                    "width": win_width,
-                    "height": min(win_height - win_row, lineno + 1),
-                    "anchor": "NW",
-                    "style": None
-                    if self.options.output_window_borders
-                    else "minimal",
-                    "border": "rounded"
-                    if self.options.output_window_borders
-                    else "none",
-                    "focusable": False,
-                },
+            lines = [""]
+        # Replace the whole buffer contents and open the output window in a
+        # single RPC
+        calls: List[List[Any]] = [
+            [
+                "nvim_buf_set_lines",
+                [
+                    self.display_buffer.number,
+                    0,
+                    -1,
+                    True,
+                    [self._get_header_text(self.output)] + lines,
+                ],
+            ]
+        ]
+        # If the window is still open (i.e., it is being redrawn), it is just
+        # moved, rather than closed and opened again.
+        window_config = {
+            "relative": "win",
+            "col": 0,
+            "row": win_row,
+            "width": win_width,
+            "height": min(win_height - win_row, lineno + 1),
+            "anchor": "NW",
+            "style": None if borders else "minimal",
+            "border": "rounded" if borders else "none",
+            "focusable": False,
+        }
+        if win_row >= win_height:
+            if self.display_window is not None:
+                calls.append(["nvim_win_close", [self.display_window, True]])
+                self.display_window = None
+        elif self.display_window is not None:
+            calls.append(
+                ["nvim_win_set_config", [self.display_window, window_config]]
+            )
+        else:
+            calls.append(
+                [
+                    "nvim_open_win",
+                    [self.display_buffer.number, False, window_config],
+                ]
             )
+        results, error = self.nvim.api.call_atomic(calls)
+        if error is not None:
+            index, _, message = error
+            if calls[index][0] == "nvim_win_set_config":
+                # The window was closed from outside of Magma; open a new one.
+                self.display_window = None
+                self.show(anchor, view)
+                return
+            raise MagmaException(f"Failed to show output: {message}")
+        if calls[-1][0] == "nvim_open_win":
+            self.display_window = results[-1].handle
             # self.nvim.funcs.nvim_win_set_option(
             #     self.display_window, "wrap", True
             # )
+
+
+_STATUS_TEXTS = {
+    (OutputStatus.HOLD, True): "* On Hold",
+    (OutputStatus.HOLD, False): "* On Hold",
+    (OutputStatus.RUNNING, True): "... Running",
+    (OutputStatus.RUNNING, False): "... Running",
+    (OutputStatus.DONE, True): "✓ Done",
+    (OutputStatus.DONE, False): "✗ Failed",
+}
+
+
+# The header only depends on these few values, which rarely change between
+# redraws.
+@lru_cache(maxsize=64)
+def _get_header_text(
+    execution_count: Optional[int],
+    status: OutputStatus,
+    success: bool,
+    old: bool,
+) -> str:
+    if execution_count is None:
+        execution_count_text = "..."
+    else:
+        execution_count_text = str(execution_count)
+
+    try:
+        status_text = _STATUS_TEXTS[status, success]
+    except KeyError:
+        raise ValueError("bad output.status: %s" % status)
+
+    if old:
+        old_text = "[OLD] "
+    else:
+        old_text = ""
+
+    return f"{old_text}Out[{execution_count_text}]: {status_text}"
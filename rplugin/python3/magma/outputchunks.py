@@ -6,13 +6,22 @@ from typing import (
     Any,
     Callable,
     IO,
+    Set,
 )
+from collections import OrderedDict
 from contextlib import AbstractContextManager
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
+from functools import lru_cache
 from abc import ABC, abstractmethod
 from math import floor
 import re
 import textwrap
+import binascii
+import hashlib
+import struct
+import threading
+import json
 import os
 
 from magma.images import Canvas
@@ -20,8 +29,16 @@ from magma.options import MagmaOptions
 
 
 class OutputChunk(ABC):
-    jupyter_data: Optional[Dict[str, Any]] = None
-    jupyter_metadata: Optional[Dict[str, Any]] = None
+    # There can be a lot of output chunks around, and slots make them
+    # considerably smaller.
+    __slots__ = ("jupyter_data", "jupyter_metadata")
+
+    jupyter_data: Optional[Dict[str, Any]]
+    jupyter_metadata: Optional[Dict[str, Any]]
+
+    def __init__(self) -> None:
+        self.jupyter_data = None
+        self.jupyter_metadata = None
 
     @abstractmethod
     def place(
@@ -35,16 +52,32 @@ class OutputChunk(ABC):
 
 # Adapted from [https://stackoverflow.com/a/14693789/4803382]:
 ANSI_CODE_REGEX = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+_remove_ansi_codes = ANSI_CODE_REGEX.sub
 def clean_up_text(text: str) -> str:
-    text = ANSI_CODE_REGEX.sub("", text)
-    text = text.replace("\r\n", "\n")
+    # Most text has no escape codes or carriage returns at all, and looking
+    # for a single character is much cheaper than running the regex over it.
+    if "\x1b" in text:
+        text = _remove_ansi_codes("", text)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n")
     return text
 
 class TextOutputChunk(OutputChunk):
+    __slots__ = ("text", "_placed", "_cleaned")
+
     text: str
 
+    # The text is redrawn whenever the interface is, but only changes along
+    # with the wrapping width (`None` when not wrapping), so the last result
+    # is kept, as is the cleaned up text (which doesn't depend on the width).
+    _placed: Optional[Tuple[Optional[int], str]]
+    _cleaned: Optional[str]
+
     def __init__(self, text: str):
+        super().__init__()
         self.text = text
+        self._placed = None
+        self._cleaned = None
 
     def _cleanup_text(self, text: str) -> str:
         return clean_up_text(text)
@@ -56,22 +89,69 @@ class TextOutputChunk(OutputChunk):
         shape: Tuple[int, int, int, int],
         __: Canvas,
     ) -> str:
-        text = self._cleanup_text(self.text)
-        if options.wrap_output:
-            win_width = shape[2]
+        win_width = shape[2] if options.wrap_output else None
+        if self._placed is not None and self._placed[0] == win_width:
+            return self._placed[1]
+
+        if self._cleaned is None:
+            self._cleaned = self._cleanup_text(self.text)
+        text = self._cleaned
+        if win_width is not None:
+            # Lines which already fit (and have no whitespace that `textwrap`
+            # would replace or drop) are left alone, and a single wrapper is
+            # used for the rest.
+            wrapper = textwrap.TextWrapper(width=win_width)
             text = "\n".join(
-                "\n".join(textwrap.wrap(line, width=win_width))
+                line
+                if len(line) <= win_width
+                and line.isprintable()
+                and not line.endswith(" ")
+                else "\n".join(wrapper.wrap(line))
                 for line in text.split("\n")
             )
+        self._placed = (win_width, text)
         return text
 
 
+class StreamOutputChunk(TextOutputChunk):
+    """
+    Text from a stream (e.g., stdout), to which consecutive text from the same
+    stream is appended, instead of becoming a chunk of its own.
+    """
+
+    __slots__ = ("name",)
+
+    name: str
+
+    def __init__(self, name: str, text: str):
+        super().__init__(text)
+        self.name = name
+
+    def append(self, text: str) -> None:
+        old_text = self.text
+        self.text = old_text + text
+        # An escape code (or a "\r\n") may be split between two appends, but
+        # never spans lines, so only the unfinished last line has to be
+        # cleaned up again, along with the new text.
+        if self._cleaned is not None:
+            cleaned_end = self._cleaned.rfind("\n") + 1
+            text_end = old_text.rfind("\n") + 1
+            self._cleaned = self._cleaned[:cleaned_end] + self._cleanup_text(
+                old_text[text_end:] + text
+            )
+        self._placed = None
+
+
 class TextLnOutputChunk(TextOutputChunk):
+    __slots__ = ()
+
     def __init__(self, text: str):
         super().__init__(text + "\n")
 
 
 class BadOutputChunk(TextLnOutputChunk):
+    __slots__ = ()
+
     def __init__(self, mimetypes: List[str]):
         super().__init__(
             "<No usable MIMEtype! Received mimetypes %r>" % mimetypes
@@ -79,60 +159,98 @@ class BadOutputChunk(TextLnOutputChunk):
 
 
 class MimetypesOutputChunk(TextLnOutputChunk):
+    __slots__ = ()
+
     def __init__(self, mimetypes: List[str]):
         super().__init__("[DEBUG] Received mimetypes: %r" % mimetypes)
 
 
 class ErrorOutputChunk(TextLnOutputChunk):
+    __slots__ = ()
+
     def __init__(self, name: str, message: str, traceback: List[str]):
         super().__init__(
             "\n".join(
-                [
-                    f"[Error] {name}: {message}",
-                    "Traceback:",
-                ]
-                + traceback
+                (f"[Error] {name}: {message}", "Traceback:", *traceback)
             )
         )
 
 
 class AbortedOutputChunk(TextLnOutputChunk):
+    __slots__ = ()
+
     def __init__(self) -> None:
         super().__init__("<Kernel aborted with no error message.>")
 
 
-class ImageOutputChunk(OutputChunk):
-    def __init__(
-        self, img_path: str, img_checksum: str, img_shape: Tuple[int, int]
-    ):
-        self.img_path = img_path
-        self.img_checksum = img_checksum
-        self.img_width, self.img_height = img_shape
+@lru_cache(maxsize=None)
+def _get_pty_path() -> Optional[str]:
+    # Finding the terminal means scanning the parent process' file
+    # descriptors, but it never changes, so it is only done once.
 
-    def _get_char_pixelsize(self) -> Optional[Tuple[int, int]]:
-        import termios
-        import fcntl
-        import struct
+    # FIXME: This is not really in Ueberzug's public API.
+    #        We should move this function into this codebase.
+    try:
+        from ueberzug.process import get_pty_slave
+    except ImportError:
+        return None
 
-        # FIXME: This is not really in Ueberzug's public API.
-        #        We should move this function into this codebase.
-        try:
-            from ueberzug.process import get_pty_slave
-        except ImportError:
+    pty = get_pty_slave(os.getppid())
+    assert pty is not None
+    return pty  # type: ignore
+
+
+@lru_cache(maxsize=None)
+def get_char_pixelsize() -> Optional[Tuple[int, int]]:
+    """
+    Get the size of a terminal cell, in pixels, if it can be determined.
+
+    This is cached, as it is needed on every redraw; the cache has to be
+    cleared (with `get_char_pixelsize.cache_clear()`) when the terminal is
+    resized.
+    """
+
+    import termios
+    import fcntl
+
+    pty = _get_pty_path()
+    if pty is None:
+        return None
+
+    with open(pty) as fd_pty:
+        farg = struct.pack("HHHH", 0, 0, 0, 0)
+        fretint = fcntl.ioctl(fd_pty, termios.TIOCGWINSZ, farg)
+        rows, cols, xpixels, ypixels = struct.unpack("HHHH", fretint)
+
+        if xpixels == 0 and ypixels == 0:
             return None
 
-        pty = get_pty_slave(os.getppid())
-        assert pty is not None
+        return max(1, xpixels // cols), max(1, ypixels // rows)
 
-        with open(pty) as fd_pty:
-            farg = struct.pack("HHHH", 0, 0, 0, 0)
-            fretint = fcntl.ioctl(fd_pty, termios.TIOCGWINSZ, farg)
-            rows, cols, xpixels, ypixels = struct.unpack("HHHH", fretint)
 
-            if xpixels == 0 and ypixels == 0:
-                return None
+class ImageOutputChunk(OutputChunk):
+    __slots__ = (
+        "img_path",
+        "img_checksum",
+        "img_width",
+        "img_height",
+        "_aspect_ratio",
+    )
+
+    img_path: str
+    img_checksum: str
+    img_width: int
+    img_height: int
+    _aspect_ratio: float
 
-            return max(1, xpixels // cols), max(1, ypixels // rows)
+    def __init__(
+        self, img_path: str, img_checksum: str, img_shape: Tuple[int, int]
+    ):
+        super().__init__()
+        self.img_path = img_path
+        self.img_checksum = img_checksum
+        self.img_width, self.img_height = img_shape
+        self._aspect_ratio = self.img_width / max(1, self.img_height)
 
     def _determine_n_lines(
         self, lineno: int, shape: Tuple[int, int, int, int]
@@ -140,20 +258,19 @@ class ImageOutputChunk(OutputChunk):
         _, y, w, h = shape
 
         max_nlines = max(0, (h - y) - lineno - 1)
+        if max_nlines == 0:
+            return 0
 
-        maybe_pixelsizes = self._get_char_pixelsize()
+        maybe_pixelsizes = get_char_pixelsize()
         if maybe_pixelsizes is not None:
             xpixels, ypixels = maybe_pixelsizes
 
-            if (
-                (self.img_width / xpixels) / (self.img_height / ypixels)
-            ) * max_nlines <= w:
+            # The width, in cells, of each line of the image.
+            line_width = self._aspect_ratio * (ypixels / xpixels)
+            if line_width * max_nlines <= w:
                 nlines = max_nlines
             else:
-                nlines = floor(
-                    ((self.img_height / ypixels) / (self.img_width / xpixels))
-                    * w
-                )
+                nlines = floor(w / line_width)
             nlines = min(nlines, self.img_height // ypixels)
         else:
             nlines = max_nlines // 3
@@ -169,6 +286,8 @@ class ImageOutputChunk(OutputChunk):
     ) -> str:
         x, y, w, h = shape
         nlines = self._determine_n_lines(lineno, shape)
+        if nlines == 0:
+            return ""
 
         canvas.add_image(
             self.img_path,
@@ -188,6 +307,15 @@ class OutputStatus(Enum):
 
 
 class Output:
+    __slots__ = (
+        "execution_count",
+        "chunks",
+        "status",
+        "success",
+        "old",
+        "_should_clear",
+    )
+
     execution_count: Optional[int]
     chunks: List[OutputChunk]
     status: OutputStatus
@@ -206,81 +334,343 @@ class Output:
         self._should_clear = False
 
 
-def to_outputchunk(
-    alloc_file: Callable[
-        [str, str],
-        "AbstractContextManager[Tuple[str, IO[bytes]]]",
-    ],
-    data: Dict[str, Any],
-    metadata: Dict[str, Any],
-) -> OutputChunk:
-    def _to_image_chunk(path: str) -> OutputChunk:
-        import hashlib
+AllocFile = Callable[
+    [str, str],
+    "AbstractContextManager[Tuple[str, IO[bytes]]]",
+]
+
+
+@lru_cache(maxsize=None)
+def _get_image_hasher_type() -> Callable[[], Any]:
+    # The checksum only identifies the image (see `Canvas.add_image`), so any
+    # fast hash will do; blake3 is optional. Failed imports aren't cached by
+    # Python, so this is only worked out once.
+    try:
+        import blake3
+    except ImportError:
+        return lambda: hashlib.blake2b(digest_size=16)
+
+    return blake3.blake3  # type: ignore
+
+
+def _new_image_hasher() -> Any:
+    """
+    Return a new hash object (with `update`) for `_get_hasher_checksum`.
+    """
+
+    return _get_image_hasher_type()()
+
+
+def _get_hasher_checksum(hasher: Any) -> str:
+    # (blake3's digest can be of any length, and starts the same regardless.)
+    return hasher.digest()[:16].hex()  # type: ignore
+
+
+def _get_image_checksum(data: bytes) -> str:
+    hasher = _new_image_hasher()
+    hasher.update(data)
+    return _get_hasher_checksum(hasher)
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _get_png_size(data: bytes) -> Optional[Tuple[int, int]]:
+    # A PNG starts with its signature and then the IHDR chunk, whose data
+    # (after its length and type) starts with the width and the height.
+    if data[:8] != PNG_SIGNATURE or data[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", data[16:24])  # type: ignore
+
+
+def _make_image_chunk(path: str, header: bytes, checksum: str) -> OutputChunk:
+    # All of the converters write PNGs, whose size can be read without PIL.
+    size = _get_png_size(header)
+    if size is None:
         from PIL import Image
 
-        pil_image = Image.open(path)
-        return ImageOutputChunk(
-            path,
-            hashlib.md5(pil_image.tobytes()).hexdigest(),
-            pil_image.size,
-        )
+        with Image.open(path) as pil_image:
+            size = pil_image.size
+    return ImageOutputChunk(path, checksum, size)
+
+
+def _to_image_chunk(path: str) -> OutputChunk:
+    # The checksum is of the (compressed) file rather than of the decoded
+    # pixels, which would be much bigger.
+    with open(path, "rb") as file:
+        data = file.read()
+    return _make_image_chunk(path, data, _get_image_checksum(data))
+
 
-    # Output chunk functions:
-    def _from_image_png(imgdata: bytes) -> OutputChunk:
-        import base64
+# Must be a multiple of 4, so that each block decodes on its own.
+BASE64_BLOCK_SIZE = 1 << 18
+BASE64_WHITESPACE_REGEX = re.compile(r"\s")
 
-        with alloc_file("png", "wb") as (path, file):
-            file.write(base64.b64decode(str(imgdata)))
-        return _to_image_chunk(path)
 
-    def _from_image_svgxml(svg: str) -> OutputChunk:
-        import cairosvg
+# Output chunk functions:
 
-        with alloc_file("png", "wb") as (path, file):
-            cairosvg.svg2png(svg, write_to=file)
-        return _to_image_chunk(path)
 
-    def _from_application_plotly(figure_json: Any) -> OutputChunk:
-        from plotly.io import from_json
-        import json
+def _from_image_png(alloc_file: AllocFile, imgdata: str) -> OutputChunk:
+    if isinstance(imgdata, bytes):
+        imgdata = imgdata.decode("ascii")
+    # Line breaks would misalign the blocks, but are rarely there.
+    if BASE64_WHITESPACE_REGEX.search(imgdata) is not None:
+        imgdata = BASE64_WHITESPACE_REGEX.sub("", imgdata)
+
+    # The image is decoded a block at a time, so that it is never all in
+    # memory (on top of its base64 encoding); `a2b_base64` takes ASCII
+    # strings as they are. Each block is hashed as it is written, so the file
+    # doesn't have to be read back.
+    hasher = _new_image_hasher()
+    header = b""
+    with alloc_file("png", "wb") as (path, file):
+        for start in range(0, len(imgdata), BASE64_BLOCK_SIZE):
+            block = binascii.a2b_base64(
+                imgdata[start : start + BASE64_BLOCK_SIZE]
+            )
+            if start == 0:
+                header = block
+            file.write(block)
+            hasher.update(block)
+    return _make_image_chunk(path, header, _get_hasher_checksum(hasher))
 
-        figure = from_json(json.dumps(figure_json))
 
-        with alloc_file("png", "wb") as (path, file):
-            figure.write_image(file, engine="kaleido")
-        return _to_image_chunk(path)
+def _from_image_svgxml(alloc_file: AllocFile, svg: str) -> OutputChunk:
+    import cairosvg
 
-    def _from_latex(tex: str) -> OutputChunk:
-        from pnglatex import pnglatex
+    with alloc_file("png", "wb") as (path, file):
+        cairosvg.svg2png(svg, write_to=file)
+    return _to_image_chunk(path)
 
-        with alloc_file("png", "w") as (path, _):
-            pass
-        pnglatex(tex, path)
-        return _to_image_chunk(path)
 
-    def _from_plaintext(text: str) -> OutputChunk:
-        return TextLnOutputChunk(text)
+def _from_application_plotly(
+    alloc_file: AllocFile, figure_json: Any
+) -> OutputChunk:
+    from plotly.graph_objects import Figure
+
+    # This is what `plotly.io.from_json` does once it has parsed the JSON.
+    figure = Figure(figure_json)
 
-    OUTPUT_CHUNKS = {
-        "image/png": _from_image_png,
-        "image/svg+xml": _from_image_svgxml,
-        "application/vnd.plotly.v1+json": _from_application_plotly,
-        "text/latex": _from_latex,
-        "text/plain": _from_plaintext,
-    }
+    with alloc_file("png", "wb") as (path, file):
+        figure.write_image(file, engine="kaleido")
+    return _to_image_chunk(path)
 
-    chunk = None
-    for mimetype, process_func in OUTPUT_CHUNKS.items():
+
+def _from_latex(alloc_file: AllocFile, tex: str) -> OutputChunk:
+    from pnglatex import pnglatex
+
+    with alloc_file("png", "w") as (path, _):
+        pass
+    pnglatex(tex, path)
+    return _to_image_chunk(path)
+
+
+def _from_plaintext(_: AllocFile, text: str) -> OutputChunk:
+    return TextLnOutputChunk(text)
+
+
+# In order of preference:
+OUTPUT_CHUNKS: Dict[str, Callable[[AllocFile, Any], OutputChunk]] = {
+    "image/png": _from_image_png,
+    "image/svg+xml": _from_image_svgxml,
+    "application/vnd.plotly.v1+json": _from_application_plotly,
+    "text/latex": _from_latex,
+    "text/plain": _from_plaintext,
+}
+
+# Mimetypes whose conversion needs an optional dependency which isn't
+# installed.
+_UNAVAILABLE_MIMETYPES: Set[str] = set()
+
+
+class ImageCache:
+    """
+    Images which were already converted, keyed by their undecoded payload.
+
+    The same image is often output over and over (e.g., a plot being redrawn
+    in a loop), and this allows skipping decoding (or rendering), writing and
+    hashing it again. The files belong to whoever allocated them (and are
+    deleted along with it), so each runtime must have its own cache.
+    """
+
+    MAX_SIZE = 128
+
+    # Maps the hash of the payload to the image's path, checksum and size,
+    # least recently used first.
+    entries: "OrderedDict[str, Tuple[str, str, Tuple[int, int]]]"
+    # Conversions happen in the background, possibly many at once.
+    lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[ImageOutputChunk]:
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is None:
+                return None
+            self.entries.move_to_end(key)
+        return ImageOutputChunk(*cached)
+
+    def put(self, key: str, chunk: ImageOutputChunk) -> None:
+        with self.lock:
+            self.entries[key] = (
+                chunk.img_path,
+                chunk.img_checksum,
+                (chunk.img_width, chunk.img_height),
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.MAX_SIZE:
+                self.entries.popitem(last=False)
+
+
+def _get_payload_key(mimetype: str, payload: Any) -> str:
+    if not isinstance(payload, (str, bytes)):
+        payload = json.dumps(payload, sort_keys=True)
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return _get_image_checksum(mimetype.encode("utf-8") + b"\0" + payload)
+
+
+def _convert_cached(
+    alloc_file: AllocFile,
+    image_cache: Optional[ImageCache],
+    mimetype: str,
+    payload: Any,
+) -> OutputChunk:
+    process_func = OUTPUT_CHUNKS[mimetype]
+    if image_cache is None or mimetype == "text/plain":
+        return process_func(alloc_file, payload)
+
+    key = _get_payload_key(mimetype, payload)
+    cached = image_cache.get(key)
+    if cached is not None:
+        return cached
+
+    chunk = process_func(alloc_file, payload)
+    if isinstance(chunk, ImageOutputChunk):
+        image_cache.put(key, chunk)
+    return chunk
+
+
+def _convert_to_outputchunk(
+    alloc_file: AllocFile,
+    image_cache: Optional[ImageCache],
+    data: Dict[str, Any],
+) -> OutputChunk:
+    for mimetype in OUTPUT_CHUNKS:
+        if mimetype not in data or mimetype in _UNAVAILABLE_MIMETYPES:
+            continue
+        maybe_data = data[mimetype]
+        if maybe_data is None:
+            continue
         try:
-            maybe_data = data.get(mimetype)
-            if maybe_data is not None:
-                chunk = process_func(maybe_data)  # type: ignore
-                break
+            return _convert_cached(
+                alloc_file, image_cache, mimetype, maybe_data
+            )
         except ImportError:
-            continue
+            # The optional dependency isn't installed, so don't try again.
+            _UNAVAILABLE_MIMETYPES.add(mimetype)
+
+    return BadOutputChunk(list(data.keys()))
+
+
+class PendingOutputChunk(OutputChunk):
+    """
+    An output chunk which is still being converted in the background, and is
+    shown as a placeholder until it is ready.
+    """
 
-    if chunk is None:
-        chunk = BadOutputChunk(list(data.keys()))
+    __slots__ = ("future",)
+
+    future: "Future[OutputChunk]"
+
+    def __init__(self, future: "Future[OutputChunk]"):
+        super().__init__()
+        self.future = future
+
+    def place(
+        self,
+        options: MagmaOptions,
+        lineno: int,
+        shape: Tuple[int, int, int, int],
+        canvas: Canvas,
+    ) -> str:
+        if not self.future.done():
+            return "<Rendering output...>\n"
+
+        try:
+            chunk = self.future.result()
+        except Exception as err:
+            chunk = TextLnOutputChunk(f"<Failed to render output: {err}>")
+        return chunk.place(options, lineno, shape, canvas)
+
+
+# Output whose conversion may take a while (rasterizing SVGs and LaTeX,
+# exporting Plotly figures, writing and hashing images) is converted in the
+# background, so as not to block NeoVim.
+_SLOW_MIMETYPES = [
+    mimetype for mimetype in OUTPUT_CHUNKS if mimetype != "text/plain"
+]
+_conversion_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _get_conversion_pool() -> ThreadPoolExecutor:
+    global _conversion_pool
+
+    if _conversion_pool is None:
+        _conversion_pool = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="magma-output"
+        )
+    return _conversion_pool
+
+
+def _import_pil() -> None:
+    try:
+        import PIL.Image  # noqa: F401
+    except ImportError:
+        pass
+
+
+def prewarm_converters() -> None:
+    """
+    Import PIL (which is optional, slow to import, and needed for every image
+    output) in the background, so that the first image output doesn't have to
+    wait for it. The other converters are only needed for some outputs, and
+    stay imported lazily.
+    """
+
+    _get_conversion_pool().submit(_import_pil)
+
+
+def to_outputchunk(
+    alloc_file: AllocFile,
+    data: Dict[str, Any],
+    metadata: Dict[str, Any],
+    on_ready: Optional[Callable[[], None]] = None,
+    image_cache: Optional[ImageCache] = None,
+) -> OutputChunk:
+    """
+    `on_ready`, if given, is called (from a background thread) if the chunk
+    is converted in the background, once it is ready to be shown.
+
+    `image_cache`, if given, must only hold files allocated by `alloc_file`.
+    """
+
+    chunk: OutputChunk
+    if any(
+        mimetype in data and mimetype not in _UNAVAILABLE_MIMETYPES
+        for mimetype in _SLOW_MIMETYPES
+    ):
+        future = _get_conversion_pool().submit(
+            _convert_to_outputchunk, alloc_file, image_cache, data
+        )
+        if on_ready is not None:
+            future.add_done_callback(lambda _: on_ready())
+        chunk = PendingOutputChunk(future)
+    else:
+        chunk = _convert_to_outputchunk(alloc_file, image_cache, data)
 
     chunk.jupyter_data = data
     chunk.jupyter_metadata = metadata
@@ -1,7 +1,20 @@
-from typing import Optional, Tuple, List, Dict, Generator, IO, Any
+from typing import (
+    Optional,
+    Tuple,
+    List,
+    Dict,
+    Set,
+    Generator,
+    IO,
+    Any,
+    Callable,
+)
 from enum import Enum
 from contextlib import contextmanager
 from queue import Empty as EmptyQueueException
+from collections import deque
+from concurrent.futures import Future, wait as wait_for_futures
+import threading
 import os
 import tempfile
 import json
@@ -9,16 +22,22 @@ import json
 import jupyter_client
 
 from magma.options import MagmaOptions
+from magma.utils import MagmaException
 from magma.outputchunks import (
     Output,
+    ImageCache,
     MimetypesOutputChunk,
+    OutputChunk,
     ErrorOutputChunk,
-    TextOutputChunk,
+    StreamOutputChunk,
     OutputStatus,
+    PendingOutputChunk,
     to_outputchunk,
     clean_up_text
 )
 
+ALLOC_FILE_BUFFER_SIZE = 1 << 20
+
 
 class RuntimeState(Enum):
     STARTING = 0
@@ -34,13 +53,57 @@ class JupyterRuntime:
     kernel_client: jupyter_client.KernelClient
 
     allocated_files: List[str]
+    # Images converted from output, whose files are all in `allocated_files`.
+    image_cache: ImageCache
 
     options: MagmaOptions
 
-    def __init__(self, kernel_name: str, options: MagmaOptions):
+    # Once the kernel is ready, IOPub messages are received by a background
+    # thread (which is then the only one using that socket), so that we get
+    # to know about new output as soon as it arrives. There is a single
+    # producer and a single consumer, so a deque (whose `append` and
+    # `popleft` are atomic) is enough, without the locking of a `Queue`.
+    iopub_messages: "deque[Dict[str, Any]]"
+    iopub_thread: Optional[threading.Thread]
+    iopub_thread_stop: threading.Event
+    on_iopub_message: Optional[Callable[[], None]]
+    on_iopub_error: Optional[Callable[[str], None]]
+    # Set when an output chunk which was being converted in the background is
+    # ready to be shown.
+    chunk_ready: threading.Event
+    # Output chunks still being converted in the background.
+    conversions: Set["Future[OutputChunk]"]
+    deinitialized: bool
+
+    def __init__(
+        self,
+        kernel_name: str,
+        options: MagmaOptions,
+        on_iopub_message: Optional[Callable[[], None]] = None,
+        on_iopub_error: Optional[Callable[[str], None]] = None,
+    ):
+        """
+        `on_iopub_message`, if given, is called from a background thread
+        whenever a new IOPub message is available to `tick`, or an output
+        chunk converted in the background is ready.
+
+        `on_iopub_error`, if given, is called from a background thread with a
+        description of any error while receiving IOPub messages.
+        """
+
         self.state = RuntimeState.STARTING
         self.kernel_name = kernel_name
 
+        self.iopub_messages = deque()
+        self.iopub_thread = None
+        self.iopub_thread_stop = threading.Event()
+        self.on_iopub_message = on_iopub_message
+        self.on_iopub_error = on_iopub_error
+        self.chunk_ready = threading.Event()
+        self.image_cache = ImageCache()
+        self.conversions = set()
+        self.deinitialized = False
+
         if ".json" not in self.kernel_name:
 
             self.external_kernel = True
@@ -80,9 +143,21 @@ class JupyterRuntime:
         return self.state.value > RuntimeState.STARTING.value
 
     def deinit(self) -> None:
+        self._stop_iopub_thread()
+
+        # Conversions still running would allocate files (and notify us)
+        # after everything is cleaned up.
+        self.deinitialized = True
+        conversions = list(self.conversions)
+        for future in conversions:
+            future.cancel()
+        wait_for_futures(conversions)
+
         for path in self.allocated_files:
-            if os.path.exists(path):
+            try:
                 os.remove(path)
+            except FileNotFoundError:
+                pass
 
         if self.external_kernel is False:
             self.kernel_client.shutdown()
@@ -91,9 +166,47 @@ class JupyterRuntime:
         self.kernel_manager.interrupt_kernel()
 
     def restart(self) -> None:
+        # `wait_for_ready` reads from IOPub as well.
+        self._stop_iopub_thread()
         self.state = RuntimeState.STARTING
         self.kernel_manager.restart_kernel()
 
+    def _start_iopub_thread(self) -> None:
+        assert self.iopub_thread is None
+        self.iopub_thread_stop.clear()
+        self.iopub_thread = threading.Thread(
+            target=self._receive_iopub_messages, daemon=True
+        )
+        self.iopub_thread.start()
+
+    def _stop_iopub_thread(self) -> None:
+        if self.iopub_thread is None:
+            return
+        self.iopub_thread_stop.set()
+        self.iopub_thread.join()
+        self.iopub_thread = None
+
+    def _receive_iopub_messages(self) -> None:
+        while not self.iopub_thread_stop.is_set():
+            try:
+                self._receive_iopub_message(timeout=0.1)
+            except EmptyQueueException:
+                continue
+            except Exception as err:
+                # Nothing else reads IOPub while this thread is running, so it
+                # must not die on a single bad message.
+                if self.on_iopub_error is not None:
+                    self.on_iopub_error(
+                        f"Error receiving output: {type(err).__name__}: {err}"
+                    )
+                self.iopub_thread_stop.wait(0.1)
+
+    def _receive_iopub_message(self, timeout: float) -> None:
+        message = self.kernel_client.get_iopub_msg(timeout=timeout)
+        self.iopub_messages.append(message)
+        if self.on_iopub_message is not None:
+            self.on_iopub_message()
+
     def run_code(self, code: str) -> None:
         self.kernel_client.execute(code)
 
@@ -101,8 +214,16 @@ class JupyterRuntime:
     def _alloc_file(
         self, extension: str, mode: str
     ) -> Generator[Tuple[str, IO[bytes]], None, None]:
+        if self.deinitialized:
+            raise MagmaException("The runtime has been deinitialized")
+
+        # Some writers (e.g. cairo, when writing PNGs) write in small pieces,
+        # so a larger buffer saves a lot of system calls.
         with tempfile.NamedTemporaryFile(
-            suffix="." + extension, mode=mode, delete=False
+            suffix="." + extension,
+            mode=mode,
+            buffering=ALLOC_FILE_BUFFER_SIZE,
+            delete=False,
         ) as file:
             path = file.name
             yield path, file
@@ -114,7 +235,29 @@ class JupyterRuntime:
         if self.options.show_mimetype_debug:
             output.chunks.append(MimetypesOutputChunk(list(data.keys())))
 
-        output.chunks.append(to_outputchunk(self._alloc_file, data, metadata))
+        output.chunks.append(self.make_output_chunk(data, metadata))
+
+    def make_output_chunk(
+        self, data: Dict[str, Any], metadata: Dict[str, Any]
+    ) -> OutputChunk:
+        chunk = to_outputchunk(
+            self._alloc_file,
+            data,
+            metadata,
+            on_ready=self._on_chunk_ready,
+            image_cache=self.image_cache,
+        )
+        if isinstance(chunk, PendingOutputChunk):
+            self.conversions.add(chunk.future)
+            chunk.future.add_done_callback(self.conversions.discard)
+        return chunk
+
+    def _on_chunk_ready(self) -> None:
+        if self.deinitialized:
+            return
+        self.chunk_ready.set()
+        if self.on_iopub_message is not None:
+            self.on_iopub_message()
 
     def _tick_one(
         self, output: Output, message_type: str, content: Dict[str, Any]
@@ -176,7 +319,16 @@ class JupyterRuntime:
             return True
         elif message_type == "stream":
             copy_on_demand(content["text"])
-            output.chunks.append(TextOutputChunk(content["text"]))
+            last_chunk = output.chunks[-1] if output.chunks else None
+            if (
+                isinstance(last_chunk, StreamOutputChunk)
+                and last_chunk.name == content["name"]
+            ):
+                last_chunk.append(content["text"])
+            else:
+                output.chunks.append(
+                    StreamOutputChunk(content["name"], content["text"])
+                )
             return True
         elif message_type == "display_data":
             # XXX: consider content['transient'], if we end up saving execution
@@ -196,6 +348,29 @@ class JupyterRuntime:
         else:
             return False
 
+    def _merge_stream_messages(
+        self, content: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        # Output printed in a loop arrives as a flood of small stream
+        # messages; those which are already queued are merged into a single
+        # chunk, which is much cheaper to handle and to redraw.
+        texts = [content["text"]]
+        iopub_messages = self.iopub_messages
+        while iopub_messages:
+            message = iopub_messages[0]
+            if (
+                message.get("msg_type") != "stream"
+                or "content" not in message
+                or message["content"]["name"] != content["name"]
+            ):
+                break
+            iopub_messages.popleft()
+            texts.append(message["content"]["text"])
+
+        if len(texts) == 1:
+            return content
+        return {"name": content["name"], "text": "".join(texts)}
+
     def tick(self, output: Optional[Output]) -> bool:
         did_stuff = False
 
@@ -209,27 +384,41 @@ class JupyterRuntime:
                 self.kernel_client.wait_for_ready(timeout=0)
                 self.state = RuntimeState.IDLE
                 did_stuff = True
+                self._start_iopub_thread()
             except RuntimeError:
                 return False
 
+        # The chunk is already in its output, but that has to be redrawn.
+        if self.chunk_ready.is_set():
+            self.chunk_ready.clear()
+            did_stuff = True
+
+        # Should the IOPub thread have died anyway, read the messages here.
+        if self.iopub_thread is not None and not self.iopub_thread.is_alive():
+            while True:
+                try:
+                    self._receive_iopub_message(timeout=0)
+                except EmptyQueueException:
+                    break
+
         if output is None:
             return did_stuff
 
-        while True:
-            try:
-                message = self.kernel_client.get_iopub_msg(timeout=0)
+        while self.iopub_messages:
+            message = self.iopub_messages.popleft()
 
-                if "content" not in message or "msg_type" not in message:
-                    continue
+            if "content" not in message or "msg_type" not in message:
+                continue
 
-                did_stuff_now = self._tick_one(
-                    output, message["msg_type"], message["content"]
-                )
-                did_stuff = did_stuff or did_stuff_now
+            message_type = message["msg_type"]
+            content = message["content"]
+            if message_type == "stream":
+                content = self._merge_stream_messages(content)
 
-                if output.status == OutputStatus.DONE:
-                    break
-            except EmptyQueueException:
+            did_stuff_now = self._tick_one(output, message_type, content)
+            did_stuff = did_stuff or did_stuff_now
+
+            if output.status == OutputStatus.DONE:
                 break
 
         return did_stuff
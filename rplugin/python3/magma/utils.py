@@ -1,4 +1,4 @@
-from typing import Union, List
+from typing import Union, List, Optional, Tuple
 
 from pynvim import Nvim
 
@@ -27,11 +27,17 @@ class Position:
         self.lineno = lineno
         self.colno = colno
 
+    def to_tuple(self) -> Tuple[int, int]:
+        return self.lineno, self.colno
+
     def __lt__(self, other: "Position") -> bool:
-        return (self.lineno, self.colno) < (other.lineno, other.colno)
+        return self.to_tuple() < other.to_tuple()
 
     def __le__(self, other: "Position") -> bool:
-        return (self.lineno, self.colno) <= (other.lineno, other.colno)
+        return self.to_tuple() <= other.to_tuple()
+
+
+MAX_EXTMARK_POOL_SIZE = 256
 
 
 class DynamicPosition(Position):
@@ -40,6 +46,7 @@ class DynamicPosition(Position):
     bufno: int
 
     extmark_id: int
+    pool: Optional[List[int]]
 
     def __init__(
         self,
@@ -48,27 +55,59 @@ class DynamicPosition(Position):
         bufno: int,
         lineno: int,
         colno: int,
+        pool: Optional[List[int]] = None,
     ):
+        """
+        If `pool` is given, it is used as a free-list of extmark IDs (for this
+        buffer and namespace): an ID is taken from it, if available, instead of
+        allocating a new extmark, and the ID is given back to it instead of
+        deleting the extmark once this position is no longer used.
+        """
+
         self.nvim = nvim
         self.extmark_namespace = extmark_namespace
+        self.pool = pool
+
+        opts = {}
+        if pool:
+            opts["id"] = pool.pop()
 
         self.bufno = bufno
-        self.extmark_id = self.nvim.funcs.nvim_buf_set_extmark(
-            self.bufno, extmark_namespace, lineno, colno, {}
-        )
+        try:
+            self.extmark_id = self.nvim.funcs.nvim_buf_set_extmark(
+                self.bufno, extmark_namespace, lineno, colno, opts
+            )
+        except Exception:
+            if "id" in opts:
+                assert pool is not None
+                pool.append(opts["id"])
+            raise
 
     def __del__(self) -> None:
+        if not hasattr(self, "extmark_id"):  # `__init__` failed
+            return
+
+        # Only so many extmarks are kept around for reuse.
+        if self.pool is not None and len(self.pool) < MAX_EXTMARK_POOL_SIZE:
+            self.pool.append(self.extmark_id)
+            return
+
         self.nvim.funcs.nvim_buf_del_extmark(
             self.bufno, self.extmark_namespace, self.extmark_id
         )
 
     def _get_pos(self) -> List[int]:
-        out = self.nvim.funcs.nvim_buf_get_extmark_by_id(
+        out = self.nvim.api.buf_get_extmark_by_id(
             self.bufno, self.extmark_namespace, self.extmark_id, {}
         )
         assert isinstance(out, list) and all(isinstance(x, int) for x in out)
         return out
 
+    def to_tuple(self) -> Tuple[int, int]:
+        # Fetch both coordinates with a single RPC.
+        lineno, colno = self._get_pos()
+        return lineno, colno
+
     @property
     def lineno(self) -> int:  # type: ignore
         return self._get_pos()[0]
@@ -91,21 +130,29 @@ class Span:
         self.end = end
 
     def __contains__(self, pos: Union[Position, DynamicPosition]) -> bool:
-        return self.begin <= pos and pos < self.end
+        # Each (dynamic) position is fetched only once.
+        pos_tuple = pos.to_tuple()
+        return (
+            self.begin.to_tuple() <= pos_tuple
+            and pos_tuple < self.end.to_tuple()
+        )
 
     def get_text(self, nvim: Nvim) -> str:
         assert self.begin.bufno == self.end.bufno
         bufno = self.begin.bufno
 
+        # Each (dynamic) position is fetched only once.
+        begin_lineno, begin_colno = self.begin.to_tuple()
+        end_lineno, end_colno = self.end.to_tuple()
         lines: List[str] = nvim.funcs.nvim_buf_get_lines(
-            bufno, self.begin.lineno, self.end.lineno + 1, True
+            bufno, begin_lineno, end_lineno + 1, True
         )
 
         if len(lines) == 1:
-            return lines[0][self.begin.colno : self.end.colno]
+            return lines[0][begin_colno:end_colno]
         else:
             return "\n".join(
-                [lines[0][self.begin.colno :]]
+                [lines[0][begin_colno:]]
                 + lines[1:-1]
-                + [lines[-1][: self.end.colno]]
+                + [lines[-1][:end_colno]]
             )
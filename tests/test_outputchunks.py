@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("pynvim")
+pytest.importorskip("jupyter_client")
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "rplugin", "python3")
+)
+
+from magma.options import MagmaOptions  # noqa: E402
+from magma.outputchunks import StreamOutputChunk  # noqa: E402
+
+
+class _Options:
+    wrap_output = False
+
+
+def _place(chunk: StreamOutputChunk) -> str:
+    options: MagmaOptions = _Options()  # type: ignore
+    return chunk.place(options, 0, (0, 0, 80, 24), None)  # type: ignore
+
+
+def test_append_split_carriage_return() -> None:
+    chunk = StreamOutputChunk("stdout", "first\r")
+    _place(chunk)
+    chunk.append("\nsecond\n")
+    assert _place(chunk) == "first\nsecond\n"
+
+
+def test_append_split_escape_code() -> None:
+    chunk = StreamOutputChunk("stdout", "done\n\x1b[3")
+    _place(chunk)
+    chunk.append("1mred\x1b[0m\n")
+    assert _place(chunk) == "done\nred\n"
+
+
+def test_append_matches_cleaning_everything() -> None:
+    pieces = ["a\x1b[", "1mb\r", "\nc", "\x1b", "[0m\r\n", "d"]
+    chunk = StreamOutputChunk("stdout", pieces[0])
+    for piece in pieces[1:]:
+        _place(chunk)
+        chunk.append(piece)
+    assert _place(chunk) == "ab\nc\nd"